@@ -1,9 +1,27 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
+import time
+import queue
+import threading
 import webbrowser
+import multiprocessing
 
-from veaperProcessing import import_aaf
+from veaperProcessing import import_aaf, MediaConverter, VeaperCancelled
+
+STAGE_NAMES = {
+    "parse": "Reading AAF",
+    "extract": "Extracting embedded audio",
+    "convert": "Converting media",
+    "write": "Writing project",
+}
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes:
+        return "%d min %02d s" % (minutes, seconds)
+    return "%d s" % seconds
 
 
 class VeaperApp(tk.Tk):
@@ -14,6 +32,14 @@ class VeaperApp(tk.Tk):
         self.configure(padx=10, pady=10)
 
         self.dragged_file_AAF = None
+        # Processing runs on a worker thread, which sends progress
+        # to the UI through this queue.
+        self.events = queue.Queue()
+        self.worker = None
+        self.converter = None
+        self.cancel_requested = threading.Event()
+        self.current_stage = None
+        self.stage_started = 0
         self.create_widgets()
 
     def create_widgets(self):
@@ -35,15 +61,21 @@ class VeaperApp(tk.Tk):
         tk.Label(self, text="2º").grid(row=2, column=0, sticky="e")
         self.start_button = tk.Button(self, text="Click here to start process and wait", command=self.start_processing, bg="dark grey", fg="black", font=("Arial", 10, "normal"))
         self.start_button.grid(row=2, column=1, sticky="w", pady=10)
+        self.cancel_button = tk.Button(self, text="Cancel", command=self.cancel_processing, state="disabled")
+        self.cancel_button.grid(row=2, column=2, sticky="w", pady=10)
+
+        # Row 4 - Progress bar
+        self.progress_bar = ttk.Progressbar(self, mode="determinate", maximum=1.0)
+        self.progress_bar.grid(row=3, column=1, columnspan=2, sticky="ew")
 
         # Row 5 - Status label
         self.status_label = tk.Label(self, text="")
-        self.status_label.grid(row=3, column=1, columnspan=2, sticky="w")
+        self.status_label.grid(row=4, column=1, columnspan=2, sticky="w")
 
         # Row 6 - Help and Footer
         self.help_button = tk.Button(self, text="Help", command=self.show_help)
-        self.help_button.grid(row=4, column=0, sticky="s")
-        tk.Label(self, text="filipelopes.net").grid(row=4, column=2, sticky="e")
+        self.help_button.grid(row=5, column=0, sticky="s")
+        tk.Label(self, text="filipelopes.net").grid(row=5, column=2, sticky="e")
 
     def browse_aaf_file(self, event=None):
         messagebox.showwarning("Warning", "Keep all MXF files in the same folder as the AAF file!")
@@ -57,25 +89,117 @@ class VeaperApp(tk.Tk):
         if not self.dragged_file_AAF:
             messagebox.showwarning("Warning", "Please select an AAF file first.")
             return
+        if self.worker is not None:
+            return
 
         self.status_label.config(text="Processing...please wait.")
-
+        self.start_button.config(state="disabled")
+        self.cancel_button.config(state="normal")
+        self.progress_bar["value"] = 0
+        self.current_stage = None
+        self.cancel_requested.clear()
+
+        self.converter = MediaConverter()
+        self.worker = threading.Thread(target=self.process_aaf, args=(self.dragged_file_AAF, self.converter),
+                                       daemon=True)
+        self.worker.start()
+        self.after(100, self.poll_events)
+
+    # Runs on the worker thread. Never touch widgets from here, nor
+    # self.converter, which the UI clears once the final event arrives.
+    def process_aaf(self, aaf_file, converter):
         try:
-            # Change working directory to the location of the AAF file
-            workdir = os.path.dirname(self.dragged_file_AAF)
-            os.chdir(workdir)
-
-            import_aaf(workdir, self.dragged_file_AAF)
-
+            import_aaf(os.path.dirname(aaf_file), aaf_file, converter, progress=self.on_progress)
+            event = ("finished", None)
+        except VeaperCancelled:
+            event = ("cancelled", None)
+        except Exception as e:
+            event = ("error", str(e))
+        # Shut the pool down before telling the UI, so a new run never
+        # overlaps this one's.
+        converter.shutdown()
+        self.events.put(event)
+
+    # Called by import_aaf on the worker thread.
+    def on_progress(self, event):
+        if self.cancel_requested.is_set():
+            raise VeaperCancelled("Processing cancelled")
+        self.events.put(("progress", event))
+
+    def cancel_processing(self):
+        if self.worker is None:
+            return
+        self.cancel_requested.set()
+        self.converter.cancel()
+        self.cancel_button.config(state="disabled")
+        self.status_label.config(text="Cancelling...")
+
+    def poll_events(self):
+        while True:
+            try:
+                kind, payload = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.show_progress(payload)
+            else:
+                self.finish_processing(kind, payload)
+                return
+        self.after(100, self.poll_events)
+
+    def show_progress(self, event):
+        if self.cancel_requested.is_set():
+            return
+        now = time.time()
+        if event["stage"] != self.current_stage:
+            self.current_stage = event["stage"]
+            self.stage_started = now
+
+        text = "%s: %s" % (STAGE_NAMES.get(event["stage"], event["stage"]), event["message"])
+        fraction = None
+        if event["total"]:
+            text += " (%d/%d)" % (event["done"], event["total"])
+            fraction = event["done"] / event["total"]
+        if event["bytes_done"]:
+            text += " %.1f MB" % (event["bytes_done"] / 1e6)
+        if event["bytes_total"]:
+            text += " of %.1f MB" % (event["bytes_total"] / 1e6)
+            fraction = event["bytes_done"] / event["bytes_total"]
+
+        if fraction is not None:
+            self.progress_bar.config(mode="determinate")
+            self.progress_bar["value"] = fraction
+            elapsed = now - self.stage_started
+            if 0 < fraction < 1 and elapsed > 1:
+                text += ", about %s left" % format_duration(elapsed * (1 - fraction) / fraction)
+        else:
+            self.progress_bar.config(mode="indeterminate")
+            self.progress_bar.step(0.05)
+        self.status_label.config(text=text)
+
+    def finish_processing(self, kind, message):
+        self.worker = None
+        self.converter = None
+        self.start_button.config(state="normal")
+        self.cancel_button.config(state="disabled")
+        self.progress_bar.config(mode="determinate")
+
+        if kind == "finished":
+            self.progress_bar["value"] = 1.0
             self.status_label.config(text="Done! Check the AAF file folder and find the Reaper Project")
             messagebox.showinfo("Finished", "Processing completed successfully.")
-        except Exception as e:
+        elif kind == "cancelled":
+            self.progress_bar["value"] = 0
+            self.status_label.config(text="Cancelled.")
+        else:
             self.status_label.config(text="Error during processing.")
-            messagebox.showerror("Error", str(e))
+            messagebox.showerror("Error", message)
 
     def show_help(self):
         webbrowser.open("https://filipelopes.net/veaper")
 
 if __name__ == "__main__":
+    # Needed for the MXF conversion worker processes in frozen (PyInstaller) builds.
+    multiprocessing.freeze_support()
     app = VeaperApp()
     app.mainloop()
@@ -0,0 +1,362 @@
+import os
+import sys
+import time
+import uuid
+import wave
+import shutil
+import struct
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+import urllib.request
+from fractions import Fraction
+
+import aaf2
+
+import veaperProcessing
+from veaperProcessing import (AAFInterface, ConversionCache, MediaConverter, parse_aaf, get_referenced_sources,
+                              convert_referenced_media, build_reaper_project)
+
+# Benchmarks for the three stages of an import: reading the AAF (parse_aaf,
+# including embedded essence extraction), converting the referenced media
+# (convert_referenced_media) and generating the project (build_reaper_project).
+#
+# Each scenario writes a synthetic AAF with pyaaf2, scaled along one axis:
+# tracks, clips per track, transitions, automation points, embedded vs
+# linked essence and source length. Linked sources are PCM MXF files. Every
+# stage is timed over a few runs (median) and then run once more under
+# tracemalloc for its peak Python memory. Results can be saved as a
+# baseline and later runs compared against it:
+#
+#    python veaperBenchmark.py --save-baseline
+#    python veaperBenchmark.py              # exits 1 on a regression
+
+BASELINE_NAME = "benchmark_baseline.json"
+EDIT_RATE = 25
+SAMPLE_RATE = 48000
+SAMPLE_BITS = 24
+CHANNELS = 1
+# A stage has regressed when it is this much slower or hungrier than its
+# baseline. Timings below MIN_SECONDS are too noisy to judge.
+TOLERANCE = 0.25
+MIN_SECONDS = 0.05
+
+SCENARIOS = {
+    "small": {"tracks": 4, "clips": 20},
+    "many_tracks": {"tracks": 64, "clips": 20},
+    "many_clips": {"tracks": 8, "clips": 500},
+    "transitions": {"tracks": 8, "clips": 200, "transitions": True},
+    "automation": {"tracks": 4, "clips": 100, "automation": 200},
+    "embedded": {"tracks": 4, "clips": 20, "embedded": True},
+    "long_sources": {"tracks": 2, "clips": 4, "sources": 2, "source_seconds": 600},
+}
+SCENARIO_DEFAULTS = {
+    "tracks": 1,
+    "clips": 1,
+    "transitions": False,
+    "automation": 0,
+    "embedded": False,
+    "sources": 4,
+    "source_seconds": 10,
+}
+
+
+# Minimal OP-Atom style MXF holding Wave wrapped PCM: header partition,
+# timeline track, Wave descriptor, one clip wrapped essence element and a
+# footer partition. Enough for veaperMxf's reader.
+def write_pcm_mxf(path, seconds, rate=SAMPLE_RATE, bits=SAMPLE_BITS, channels=CHANNELS):
+    def klv_header(key, length):
+        return key + b"\x87" + length.to_bytes(7, "big")
+
+    def local_tag(tag, value):
+        return struct.pack(">HH", tag, len(value)) + value
+
+    partition_key = bytes.fromhex("060e2b34020501010d01020101020400")
+    track_key = bytes.fromhex("060e2b34025301010d01010101013b00")
+    descriptor_key = bytes.fromhex("060e2b34025301010d01010101014800")
+    element_key = bytes.fromhex("060e2b34010201010d01030116010201")
+
+    block_align = channels * ((bits + 7) // 8)
+    track = local_tag(0x4801, struct.pack(">I", 2)) + local_tag(0x4804, bytes([0x16, 0x01, 0x02, 0x01]))
+    descriptor = (local_tag(0x3C0A, uuid.uuid4().bytes)
+                  + local_tag(0x3006, struct.pack(">I", 2))
+                  + local_tag(0x3D01, struct.pack(">I", bits))
+                  + local_tag(0x3D03, struct.pack(">ii", rate, 1))
+                  + local_tag(0x3D07, struct.pack(">I", channels))
+                  + local_tag(0x3D0A, struct.pack(">H", block_align)))
+    partition = bytes(88)
+    size = int(seconds * rate) * block_align
+    # Not silence, so nothing downstream can take a shortcut.
+    block = os.urandom(block_align * 4096)
+
+    with open(path, "wb") as mxf_file:
+        mxf_file.write(klv_header(partition_key, len(partition)) + partition)
+        mxf_file.write(klv_header(track_key, len(track)) + track)
+        mxf_file.write(klv_header(descriptor_key, len(descriptor)) + descriptor)
+        mxf_file.write(klv_header(element_key, size))
+        for start in range(0, size, len(block)):
+            mxf_file.write(block[:size - start])
+        mxf_file.write(klv_header(partition_key, len(partition)) + partition)
+
+
+def write_pcm_wav(path, seconds, rate=SAMPLE_RATE, bits=SAMPLE_BITS, channels=CHANNELS):
+    block_align = channels * ((bits + 7) // 8)
+    frames = int(seconds * rate)
+    block = os.urandom(block_align * 4096)
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(bits // 8)
+        wav_file.setframerate(rate)
+        for start in range(0, frames * block_align, len(block)):
+            wav_file.writeframesraw(block[:frames * block_align - start])
+
+
+# A master mob pointing at an external PCM file, the way Resolve links MXFs.
+def link_pcm_essence(f, name, path, seconds):
+    length = int(seconds * EDIT_RATE)
+    master_mob = f.create.MasterMob(name)
+    f.content.mobs.append(master_mob)
+
+    source_mob = f.create.SourceMob()
+    f.content.mobs.append(source_mob)
+    descriptor = f.create.PCMDescriptor()
+    descriptor["SampleRate"].value = SAMPLE_RATE
+    descriptor["AudioSamplingRate"].value = SAMPLE_RATE
+    descriptor["Channels"].value = CHANNELS
+    descriptor["QuantizationBits"].value = SAMPLE_BITS
+    descriptor["BlockAlign"].value = CHANNELS * SAMPLE_BITS // 8
+    descriptor["AverageBPS"].value = SAMPLE_RATE * CHANNELS * SAMPLE_BITS // 8
+    descriptor["Length"].value = int(seconds * SAMPLE_RATE)
+    locator = f.create.NetworkLocator()
+    locator["URLString"].value = "file:" + urllib.request.pathname2url(os.path.abspath(path))
+    descriptor["Locator"].append(locator)
+    source_mob.descriptor = descriptor
+
+    source_slot = source_mob.create_empty_sequence_slot(EDIT_RATE, media_kind="sound")
+    source_slot.segment.components.append(f.create.Filler(media_kind="sound", length=length))
+    master_slot = master_mob.create_timeline_slot(EDIT_RATE)
+    master_slot.segment = source_mob.create_source_clip(source_slot.slot_id, length=length)
+    return master_mob
+
+
+def register_operation(f, name, inputs, parameter=None):
+    operation = f.create.OperationDef(uuid.uuid4(), name, "")
+    operation.media_kind = "sound"
+    operation.number_inputs = inputs
+    operation["IsTimeWarp"].value = False
+    if parameter is not None:
+        operation.parameters.append(parameter)
+    f.dictionary.register_def(operation)
+    return operation
+
+
+def register_gain_operation(f):
+    parameter = f.create.ParameterDef(uuid.uuid4(), "Level", "", f.dictionary.lookup_typedef("Rational"))
+    f.dictionary.register_def(parameter)
+    f.dictionary.register_def(f.create.InterpolationDef(aaf2.misc.LinearInterp, "LinearInterp", ""))
+    return register_operation(f, "Audio Gain", 1, parameter), parameter
+
+
+# Wraps a clip in an "Audio Gain" operation with a volume curve of
+# points control points.
+def add_automation(f, clip, length, points, operation, parameter):
+    group = f.create.OperationGroup(operation, length=length, media_kind="sound")
+    group.segments.append(clip)
+    curve = f.create.VaryingValue(parameter, "LinearInterp")
+    for i in range(points):
+        curve.add_keyframe(Fraction(i, max(1, points - 1)), Fraction(50 + (i * 37) % 50, 100))
+    group.parameters.append(curve)
+    return group
+
+
+def create_transition(f, length, operation):
+    transition = f.create.Transition(media_kind="sound", length=length)
+    transition["OperationGroup"].value = f.create.OperationGroup(operation, length=length, media_kind="sound")
+    transition.cutpoint = length // 2
+    return transition
+
+
+# Writes a synthetic AAF (and the media it links to, in media_dir) for the
+# scenario params (see SCENARIO_DEFAULTS).
+def generate_aaf(path, media_dir, params):
+    params = dict(SCENARIO_DEFAULTS, **params)
+    os.makedirs(media_dir, exist_ok=True)
+    source_length = int(params["source_seconds"] * EDIT_RATE)
+    clip_length = max(EDIT_RATE, min(source_length, 4 * EDIT_RATE))
+    fade_length = EDIT_RATE // 2
+
+    with aaf2.open(path, "w") as f:
+        masters = []
+        for i in range(params["sources"]):
+            name = "source%03d" % i
+            if params["embedded"]:
+                wav_path = os.path.join(media_dir, name + ".wav")
+                write_pcm_wav(wav_path, params["source_seconds"])
+                master_mob = f.create.MasterMob(name)
+                f.content.mobs.append(master_mob)
+                master_mob.import_audio_essence(wav_path, EDIT_RATE)
+            else:
+                mxf_path = os.path.join(media_dir, name + ".mxf")
+                write_pcm_mxf(mxf_path, params["source_seconds"])
+                master_mob = link_pcm_essence(f, name, mxf_path, params["source_seconds"])
+            masters.append(master_mob)
+
+        if params["automation"]:
+            operation, parameter = register_gain_operation(f)
+        if params["transitions"]:
+            dissolve = register_operation(f, "Audio Dissolve", 2)
+
+        composition = f.create.CompositionMob("benchmark")
+        f.content.mobs.append(composition)
+        for track in range(params["tracks"]):
+            slot = composition.create_timeline_slot(EDIT_RATE)
+            slot.name = "A%d" % (track + 1)
+            sequence = f.create.Sequence(media_kind="sound")
+            slot.segment = sequence
+            for clip_number in range(params["clips"]):
+                master_mob = masters[(track + clip_number) % len(masters)]
+                start = (clip_number * EDIT_RATE) % max(1, source_length - clip_length)
+                clip = master_mob.create_source_clip(slot_id=1, start=start, length=clip_length)
+                if params["automation"]:
+                    clip = add_automation(f, clip, clip_length, params["automation"], operation, parameter)
+                if clip_number and params["transitions"]:
+                    sequence.components.append(create_transition(f, fade_length, dissolve))
+                elif clip_number % 5 == 4:
+                    sequence.components.append(f.create.Filler(media_kind="sound", length=EDIT_RATE))
+                sequence.components.append(clip)
+
+
+# Runs function once under tracemalloc; returns its peak allocation in bytes.
+def measure_peak(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_stage(setup, function, repeat):
+    timings = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    args = setup()
+    return {
+        "seconds": statistics.median(timings),
+        "peak_bytes": measure_peak(lambda: function(*args)),
+    }
+
+
+# Times each stage of one scenario. Every run starts from a fresh output
+# folder, so extraction and conversion really happen each time. Conversion
+# runs inline (one worker) unless workers says otherwise; memory used in
+# worker processes isn't seen by tracemalloc.
+def run_scenario(name, params, work_dir, repeat=3, workers=1):
+    scenario_dir = os.path.join(work_dir, name)
+    aaf_path = os.path.join(scenario_dir, name + ".aaf")
+    if not os.path.isfile(aaf_path):
+        generate_aaf(aaf_path, os.path.join(scenario_dir, "media"), params)
+    runs = [0]
+
+    def fresh_output():
+        runs[0] += 1
+        output = os.path.join(scenario_dir, "out%d" % runs[0])
+        shutil.rmtree(output, ignore_errors=True)
+        os.makedirs(output)
+        return output
+
+    def parse(output):
+        composition = parse_aaf(AAFInterface(scenario_dir), aaf_path, output)
+        if composition is None:
+            raise RuntimeError("Could not read %s" % aaf_path)
+        return composition
+
+    composition = parse(fresh_output())
+    results = {"parse": run_stage(lambda: (fresh_output(),), parse, repeat)}
+
+    with MediaConverter(workers) as converter:
+        def convert(output):
+            sources = get_referenced_sources(composition)
+            return convert_referenced_media(sources, scenario_dir, output, converter, ConversionCache(output))
+        results["convert"] = run_stage(lambda: (fresh_output(),), convert, repeat)
+
+    results["write"] = run_stage(lambda: (), lambda: build_reaper_project(composition, SAMPLE_RATE), repeat)
+
+    for run in range(1, runs[0] + 1):
+        shutil.rmtree(os.path.join(scenario_dir, "out%d" % run), ignore_errors=True)
+    return results
+
+
+# Returns a list of "scenario stage: what" lines for every stage that got
+# worse than its baseline by more than tolerance.
+def compare_results(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get(scenario, {}).get(stage)
+            if reference is None:
+                continue
+            if result["seconds"] > max(MIN_SECONDS, reference["seconds"] * (1 + tolerance)):
+                regressions.append("%s %s: %.3fs, baseline %.3fs"
+                                   % (scenario, stage, result["seconds"], reference["seconds"]))
+            if result["peak_bytes"] > reference["peak_bytes"] * (1 + tolerance):
+                regressions.append("%s %s: peak %.1f MB, baseline %.1f MB"
+                                   % (scenario, stage, result["peak_bytes"] / 1e6, reference["peak_bytes"] / 1e6))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Veaper on synthetic AAFs.")
+    parser.add_argument("scenario", nargs="*", help="scenarios to run (default: all): %s" % ", ".join(SCENARIOS))
+    parser.add_argument("--work-dir", help="folder for the generated AAFs and media (default: a temporary one)")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), BASELINE_NAME),
+                        help="baseline file to compare with or save to (default: %s)" % BASELINE_NAME)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (default: %(default)d)")
+    parser.add_argument("--workers", type=int, default=1, help="conversion processes (default: %(default)d)")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="allowed slowdown or memory growth, as a fraction (default: %(default)g)")
+    args = parser.parse_args(argv)
+
+    names = args.scenario or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %s" % name)
+
+    veaperProcessing.log_level = veaperProcessing.ERROR
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="veaper-benchmark-")
+    results = {}
+    try:
+        for name in names:
+            results[name] = run_scenario(name, SCENARIOS[name], work_dir, args.repeat, args.workers)
+            for stage, result in results[name].items():
+                print("%-14s %-8s %8.3fs %9.1f MB" % (name, stage, result["seconds"], result["peak_bytes"] / 1e6))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save_baseline:
+        baseline = veaperProcessing.load_json_file(args.baseline)
+        baseline.update(results)
+        veaperProcessing.write_json_file(args.baseline, baseline)
+        print("Baseline saved to %s" % args.baseline)
+        return 0
+
+    baseline = veaperProcessing.load_json_file(args.baseline)
+    if not baseline:
+        print("No baseline at %s, run with --save-baseline to create one." % args.baseline)
+        return 0
+    regressions = compare_results(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION %s" % regression)
+    if not regressions:
+        print("No regressions against %s" % args.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
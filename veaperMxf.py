@@ -0,0 +1,262 @@
+import mmap
+import struct
+import wave
+
+from veaperPeaks import PeakBuilder
+
+# Native reader for PCM audio in MXF files (OP-Atom and OP1a).
+#
+# An MXF file is a flat run of KLV packets: a 16 byte key (a SMPTE UL),
+# a BER coded length and the value. Header metadata sets describe the
+# essence, and the essence itself lives in GC (Generic Container) element
+# packets. For Wave (BWF) wrapped sound, an element value is plain
+# interleaved little endian PCM, exactly what goes into a WAV data chunk,
+# so no decoding is needed at all.
+#
+# Anything this reader doesn't understand (compressed audio, AES3 wrapped
+# sound, odd multi track layouts) makes it return None, and the caller
+# falls back to decoding through MoviePy/FFmpeg.
+
+MXF_KEY_PREFIX = b"\x06\x0e\x2b\x34"
+PARTITION_PACK_PREFIX = b"\x06\x0e\x2b\x34\x02\x05\x01\x01\x0d\x01\x02\x01\x01"
+# Run-in allowed before the header partition pack (SMPTE 377).
+MAX_RUN_IN = 65536
+
+# Byte 14 of header metadata set keys.
+MATERIAL_PACKAGE_SET = 0x36
+SOURCE_PACKAGE_SET = 0x37
+TIMELINE_TRACK_SET = 0x3B
+SOUND_DESCRIPTOR_SETS = {
+    0x47: "AES3",
+    0x48: "WAVE",
+}
+
+# Byte 12 and 14 of GC essence element keys.
+GC_SOUND_ITEM = 0x16
+BWF_ELEMENT_TYPES = (0x01, 0x02, 0x0B)  # frame-, clip- and custom-wrapped
+
+# Bytes 8 to 11 of the SMPTE sound coding ULs for uncompressed PCM, which
+# a Wave descriptor may carry in its SoundCompression. Byte 12 picks the
+# variant, all little endian but 0x7E (AIFF, big endian). Byte 7 is the
+# registry version and differs between writers.
+UNCOMPRESSED_SOUND_CODING = b"\x04\x02\x02\x01"
+BIG_ENDIAN_SOUND_CODING = 0x7E
+
+# Local tags of the sets we read.
+TAG_INSTANCE_UID = 0x3C0A
+TAG_PACKAGE_UID = 0x4401
+TAG_LINKED_TRACK_ID = 0x3006
+TAG_QUANTIZATION_BITS = 0x3D01
+TAG_AUDIO_SAMPLING_RATE = 0x3D03
+TAG_SOUND_COMPRESSION = 0x3D06
+TAG_CHANNEL_COUNT = 0x3D07
+TAG_BLOCK_ALIGN = 0x3D0A
+TAG_TRACK_ID = 0x4801
+TAG_TRACK_NUMBER = 0x4804
+
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+# Header metadata is small and sits at the start of the file.
+HEADER_READ_SIZE = 1024 * 1024
+
+
+def read_ber_length(data, pos):
+    first = data[pos]
+    if first < 0x80:
+        return first, pos + 1
+    size = first & 0x7F
+    return int.from_bytes(data[pos + 1:pos + 1 + size], "big"), pos + 1 + size
+
+
+def iter_klv(data, pos):
+    end = len(data)
+    while pos + 17 <= end:
+        key = data[pos:pos + 16]
+        if key[:4] != MXF_KEY_PREFIX:
+            return
+        length, value_pos = read_ber_length(data, pos + 16)
+        if value_pos + length > end:
+            # Truncated file, take what is there.
+            length = end - value_pos
+        yield key, value_pos, length
+        pos = value_pos + length
+
+
+def parse_local_set(data, pos, length):
+    values = {}
+    end = pos + length
+    while pos + 4 <= end:
+        tag, size = struct.unpack_from(">HH", data, pos)
+        values[tag] = data[pos + 4:pos + 4 + size]
+        pos += 4 + size
+    return values
+
+
+def is_metadata_set(key, set_type):
+    return key[4] == 0x02 and key[5] == 0x53 and key[8:14] == b"\x0d\x01\x01\x01\x01\x01" and key[14] == set_type
+
+
+def is_essence_element(key):
+    return key[4] == 0x01 and key[8:12] == b"\x0d\x01\x03\x01"
+
+
+def is_sound_element(key):
+    return is_essence_element(key) and key[12] == GC_SOUND_ITEM
+
+
+def is_uncompressed_sound(coding):
+    if not coding or not any(coding):
+        return True
+    return (len(coding) == 16 and coding[:4] == MXF_KEY_PREFIX and coding[4] == 0x04
+            and coding[8:12] == UNCOMPRESSED_SOUND_CODING and coding[12] != BIG_ENDIAN_SOUND_CODING)
+
+
+def read_uint(value):
+    return int.from_bytes(value, "big") if value else None
+
+
+# Scans the file once and returns the PCM layout plus the (offset, length)
+# of every essence element of the first sound track, or None when the file
+# can't be copied natively.
+def scan_mxf_pcm(data):
+    start = data.find(PARTITION_PACK_PREFIX, 0, MAX_RUN_IN + 16)
+    if start < 0:
+        return None
+
+    descriptors = {}
+    track_ids = {}
+    track_number = None
+    element_type = None
+    chunks = []
+
+    for key, pos, length in iter_klv(data, start):
+        if is_sound_element(key):
+            number = int.from_bytes(key[12:16], "big")
+            if track_number is None:
+                track_number = number
+                element_type = key[14]
+            if number == track_number:
+                chunks.append((pos, length))
+        elif key[4] == 0x02 and key[5] == 0x53:
+            if is_metadata_set(key, TIMELINE_TRACK_SET):
+                values = parse_local_set(data, pos, length)
+                number = read_uint(values.get(TAG_TRACK_NUMBER))
+                if number:
+                    track_ids[number] = read_uint(values.get(TAG_TRACK_ID))
+            elif key[14] in SOUND_DESCRIPTOR_SETS and is_metadata_set(key, key[14]):
+                values = parse_local_set(data, pos, length)
+                # Header and footer partitions may both carry the metadata.
+                descriptors[values.get(TAG_INSTANCE_UID, pos)] = values
+
+    if not chunks or element_type not in BWF_ELEMENT_TYPES or not descriptors:
+        return None
+
+    descriptors = list(descriptors.values())
+    linked = [d for d in descriptors if read_uint(d.get(TAG_LINKED_TRACK_ID)) == track_ids.get(track_number)]
+    if linked:
+        descriptor = linked[0]
+    elif len(descriptors) == 1:
+        descriptor = descriptors[0]
+    else:
+        return None
+
+    if not is_uncompressed_sound(descriptor.get(TAG_SOUND_COMPRESSION)):
+        return None
+
+    try:
+        channels = read_uint(descriptor[TAG_CHANNEL_COUNT])
+        bits = read_uint(descriptor[TAG_QUANTIZATION_BITS])
+        numerator, denominator = struct.unpack(">ii", descriptor[TAG_AUDIO_SAMPLING_RATE])
+    except (KeyError, struct.error):
+        return None
+    if not channels or not bits or not denominator:
+        return None
+
+    block_align = read_uint(descriptor.get(TAG_BLOCK_ALIGN)) or channels * ((bits + 7) // 8)
+    if block_align % channels:
+        return None
+
+    return {
+        "channels": channels,
+        "sample_width": block_align // channels,
+        "block_align": block_align,
+        "sample_rate": round(numerator / denominator),
+        "chunks": chunks,
+    }
+
+
+# Copies the PCM essence of an MXF file into a WAV file without decoding.
+# start and end (seconds) limit the copy to a region of the essence.
+# With peaks, the WAV's REAPER peak file is written from the same pass.
+# Returns the sample rate, or None if the file needs a real decoder.
+def mxf_pcm_to_wav(mxf_path, wav_path, start=None, end=None, peaks=False):
+    with open(mxf_path, "rb") as mxf_file:
+        try:
+            data = mmap.mmap(mxf_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return None
+
+        try:
+            info = scan_mxf_pcm(data)
+            if info is None:
+                return None
+
+            block_align = info["block_align"]
+            first = 0
+            last = None
+            if start is not None:
+                first = round(start * info["sample_rate"]) * block_align
+                last = round(end * info["sample_rate"]) * block_align
+            builder = PeakBuilder(info["channels"], info["sample_width"], info["sample_rate"]) if peaks else None
+
+            view = memoryview(data)
+            try:
+                with wave.open(wav_path, "wb") as wav_file:
+                    wav_file.setnchannels(info["channels"])
+                    wav_file.setsampwidth(info["sample_width"])
+                    wav_file.setframerate(info["sample_rate"])
+                    # stream_pos is where the current element starts in the
+                    # essence as a whole, which is what first and last count.
+                    stream_pos = 0
+                    for pos, length in info["chunks"]:
+                        length -= length % block_align
+                        copy_start = pos + max(0, first - stream_pos)
+                        copy_end = pos + length if last is None else pos + min(length, last - stream_pos)
+                        stream_pos += length
+                        for chunk_start in range(copy_start, copy_end, COPY_CHUNK_SIZE):
+                            with view[chunk_start:min(chunk_start + COPY_CHUNK_SIZE, copy_end)] as chunk:
+                                wav_file.writeframesraw(chunk)
+                                if builder is not None:
+                                    builder.add(chunk)
+                        if last is not None and stream_pos >= last:
+                            break
+            finally:
+                view.release()
+        finally:
+            data.close()
+
+    if builder is not None:
+        builder.write(wav_path)
+    return info["sample_rate"]
+
+
+# Returns the 32 byte UMIDs of the material and source packages in the
+# header metadata of an MXF file. An AAF refers to an MXF's essence by
+# these IDs (as MobIDs), so they identify a file whatever its name.
+def read_mxf_package_uids(mxf_path):
+    with open(mxf_path, "rb") as mxf_file:
+        data = mxf_file.read(HEADER_READ_SIZE)
+    start = data.find(PARTITION_PACK_PREFIX, 0, MAX_RUN_IN + 16)
+    if start < 0:
+        return []
+
+    uids = []
+    for key, pos, length in iter_klv(data, start):
+        if is_essence_element(key):
+            # The header metadata is over.
+            break
+        if is_metadata_set(key, MATERIAL_PACKAGE_SET) or is_metadata_set(key, SOURCE_PACKAGE_SET):
+            uid = parse_local_set(data, pos, length).get(TAG_PACKAGE_UID)
+            if uid and len(uid) == 32 and uid not in uids:
+                uids.append(uid)
+    return uids
@@ -0,0 +1,161 @@
+import os
+import struct
+import wave
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Writer for REAPER peak files (.reapeaks).
+#
+# REAPER draws waveforms from a peak file next to each media file, and
+# builds one by reading the whole file when it is missing. The WAV writers
+# hand their PCM to a PeakBuilder as they write it, so the peaks cost no
+# extra pass over the audio. The reductions need NumPy; in plain Python
+# they would cost more than the copy they ride along with.
+#
+# Version 1.0 ("RPKM") layout, little endian throughout:
+#   header       "RPKM", channels (1 byte), mipmap count (1 byte), source
+#                sample rate, source mtime (seconds) and source size (low
+#                32 bits), 4 bytes each
+#   per mipmap   samples per peak and peak count, 4 bytes each
+#   then, per mipmap, per peak, per channel: max and min as signed 16 bit.
+#
+# REAPER rebuilds a peak file whose mtime or size don't match its source,
+# so a stale one costs nothing but the rebuild it would have done anyway.
+
+PEAK_FILE_EXTENSION = ".reapeaks"
+PEAK_FILE_MAGIC = b"RPKM"
+PEAK_HEADER = struct.Struct("<4sBBIII")
+PEAK_MIPMAP_HEADER = struct.Struct("<II")
+# Peaks per second of each mipmap, finest first. Each must divide the first.
+PEAK_RATES = (400, 10, 1)
+
+# WAVs without a peak file are read this many frames at a time.
+PEAK_BLOCK_FRAMES = 256 * 1024
+
+
+def peak_file_path(wav_path):
+    return wav_path + PEAK_FILE_EXTENSION
+
+
+# Top 16 bits of every sample of interleaved PCM, width bytes per sample.
+# For 16 bit and wider, a strided view of the buffer.
+def top_bits(data, width):
+    if width == 1:
+        return (np.frombuffer(data, np.uint8).astype(np.int16) - 128) << 8
+    return np.ndarray((len(data) // width,), "<i2", data, width - 2, (width,))
+
+
+# Collects the min/max peaks of PCM as it is written, reduced per block of
+# division frames. Call add() with the interleaved PCM in order, in chunks
+# of any size, then write() once the WAV is closed: the header records the
+# WAV's mtime.
+class PeakBuilder:
+
+    def __init__(self, channels, width, rate):
+        if np is None:
+            raise RuntimeError("Writing peak files needs NumPy")
+        self.channels = channels
+        self.width = width
+        self.rate = int(round(rate))
+        self.division = max(1, self.rate // PEAK_RATES[0])
+        self.frame_size = channels * width
+        self.block_size = self.division * self.frame_size
+        self.rest = b""
+        # Finest mipmap, in chunks of (peaks, channels) arrays.
+        self.maxima = []
+        self.minima = []
+
+    def add(self, data):
+        start = 0
+        if self.rest:
+            # Complete the block left over from the last chunk.
+            start = min(len(data), self.block_size - len(self.rest))
+            self.rest += bytes(data[:start])
+            if len(self.rest) < self.block_size:
+                return
+            self.reduce(self.rest, self.division)
+            self.rest = b""
+        end = start + (len(data) - start) // self.block_size * self.block_size
+        if end > start:
+            self.reduce(memoryview(data)[start:end], self.division)
+        self.rest = bytes(data[end:])
+
+    def reduce(self, data, division):
+        blocks = top_bits(data, self.width).reshape(-1, division, self.channels)
+        self.maxima.append(blocks.max(axis=1))
+        self.minima.append(blocks.min(axis=1))
+
+    # The finest mipmap's (maxima, minima), the partial last block included.
+    def finish(self):
+        frames = len(self.rest) // self.frame_size
+        if frames:
+            self.reduce(self.rest[:frames * self.frame_size], frames)
+        self.rest = b""
+        empty = np.zeros((0, self.channels), np.int16)
+        return np.concatenate(self.maxima or [empty]), np.concatenate(self.minima or [empty])
+
+    # Returns [(division, peak count, data)], finest first.
+    def mipmaps(self):
+        maxima, minima = self.finish()
+        mipmaps = []
+        for peak_rate in PEAK_RATES:
+            factor = PEAK_RATES[0] // peak_rate
+            mipmaps.append((self.division * factor,) + merge_peaks(maxima, minima, factor))
+        return mipmaps
+
+    def write(self, wav_path):
+        mipmaps = self.mipmaps()
+        stat = os.stat(wav_path)
+        path = peak_file_path(wav_path)
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, "wb") as peak_file:
+                peak_file.write(PEAK_HEADER.pack(PEAK_FILE_MAGIC, self.channels, len(mipmaps), self.rate,
+                                                 int(stat.st_mtime) & 0xFFFFFFFF, stat.st_size & 0xFFFFFFFF))
+                for division, count, _ in mipmaps:
+                    peak_file.write(PEAK_MIPMAP_HEADER.pack(division, count))
+                for _, _, data in mipmaps:
+                    peak_file.write(data)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise
+        return path
+
+
+# Merges the finest peaks by factor and returns the peak count and the
+# peaks as (max, min) pairs per channel.
+def merge_peaks(maxima, minima, factor):
+    if factor > 1 and len(maxima):
+        starts = np.arange(0, len(maxima), factor)
+        maxima = np.maximum.reduceat(maxima, starts, axis=0)
+        minima = np.minimum.reduceat(minima, starts, axis=0)
+    return len(maxima), np.stack([maxima, minima], axis=2).astype("<i2").tobytes()
+
+
+def peaks_up_to_date(wav_path):
+    try:
+        stat = os.stat(wav_path)
+        with open(peak_file_path(wav_path), "rb") as peak_file:
+            header = PEAK_HEADER.unpack(peak_file.read(PEAK_HEADER.size))
+    except (OSError, struct.error):
+        return False
+    return header[0] == PEAK_FILE_MAGIC and header[4] == int(stat.st_mtime) & 0xFFFFFFFF \
+        and header[5] == stat.st_size & 0xFFFFFFFF
+
+
+# Reads a whole WAV to write its peak file, for WAVs that didn't go
+# through a PeakBuilder (staged, cached or decoded by FFmpeg).
+def write_wav_peaks(wav_path, block_frames=PEAK_BLOCK_FRAMES):
+    with wave.open(wav_path, "rb") as reader:
+        peaks = PeakBuilder(reader.getnchannels(), reader.getsampwidth(), reader.getframerate())
+        while True:
+            frames = reader.readframes(block_frames)
+            if not frames:
+                break
+            peaks.add(frames)
+    return peaks.write(wav_path)
@@ -5,200 +5,956 @@ import sys
 import wave
 import uuid
 import shutil
+import tempfile
+import errno
 import urllib.parse
 import urllib.request
 import json
-from moviepy import AudioFileClip
+import math
+import time
+import glob
+import argparse
+import threading
+import signal
+import multiprocessing
+import hashlib
+import pstats
+import cProfile
+import contextlib
+import heapq
+import operator
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+from veaperMxf import mxf_pcm_to_wav, read_mxf_package_uids
+from veaperPeaks import PeakBuilder, peaks_up_to_date, write_wav_peaks
+
+try:
+    from moviepy import AudioFileClip
+except ImportError:
+    AudioFileClip = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import soxr
+except ImportError:
+    soxr = None
+
+try:
+    from scipy.signal import resample_poly
+except ImportError:
+    resample_poly = None
 
 have_tk = False
 
 [NOTICE, WARNING, ERROR, NONE] = range(4)
-log_level = WARNING
+log_level = NOTICE
+peaks_warning_given = False
 
 sampleRateFicheiro = 48000
 
+# Conversion cache. The manifest lives next to the converted files;
+# the index lives in the shared cache directory, if one is configured.
+CACHE_MANIFEST_NAME = "conversion_manifest.json"
+SHARED_CACHE_INDEX_NAME = "cache_index.json"
+SHARED_CACHE_LOCK_NAME = "cache_index.lock"
+SHARED_CACHE_MAX_SIZE = 50 * 1024 ** 3
+FINGERPRINT_BLOCK_SIZE = 256 * 1024
+
+# A media lookup that finds nothing rescans the media folders (see
+# MediaIndex), at most once per this many seconds. Rescans that don't find
+# the file wait twice as long each time, up to the maximum.
+MEDIA_RESCAN_INTERVAL = 5.0
+MEDIA_RESCAN_MAX_INTERVAL = 600.0
+
+# Default maximum errors when thinning envelopes: decibels for volume,
+# pan units (-1 to 1) for panning.
+VOLUME_TOLERANCE_DB = 0.1
+PAN_TOLERANCE = 0.005
+
+# Seconds of extra audio kept on both sides of every used region
+# when consolidating.
+CONSOLIDATE_HANDLES = 1.0
+
+# Embedded essence is copied out of the AAF in chunks of this size,
+# so memory use doesn't grow with the length of the clip.
+ESSENCE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# How WAV sources that need no conversion get into the project folder,
+# cheapest method first; the next one is tried when one fails. "link" only
+# clones (copy-on-write), so the project never shares data with the source:
+# hard links and symlinks do, and are left to explicit opt-ins. "reference"
+# leaves the file where it is and puts its absolute path in the project.
+STAGING_POLICIES = {
+    "link": ("reflink", "copy"),
+    "hardlink": ("hardlink", "copy"),
+    "symlink": ("symlink", "copy"),
+    "copy": ("copy",),
+    "reference": ("reference",),
+}
+# Linux ioctl cloning a file's extents (copy-on-write), on Btrfs, XFS...
+FICLONE = 0x40049409
+
+# WAVs are normalized (resampled, requantized) this many frames at a time.
+NORMALIZE_BLOCK_FRAMES = 256 * 1024
+
+# Parallel extraction splits the embedded files into this many batches
+# per worker process.
+EXTRACT_BATCHES_PER_WORKER = 4
+
+# Envelope PT lines are formatted this many points at a time.
+ENVELOPE_WRITE_BATCH = 8192
+
+# Written next to the project by every import, and by --profile.
+TIMING_REPORT_NAME = "timing_report.json"
+PROFILE_NAME = "profile.prof"
+PROFILE_SUMMARY_NAME = "profile.txt"
+
+class VeaperError(Exception):
+    pass
+
+
+class VeaperCancelled(VeaperError):
+    pass
+
+
+# Progress events are dicts handed to a progress callback:
+#   stage        "parse", "extract", "convert" or "write"
+#   message      human readable description
+#   done, total  items finished / to do in this stage, if known
+#   bytes_done, bytes_total
+#                bytes processed / to process in this stage, if known
+# The callback may raise VeaperCancelled to stop the import.
+def report_progress(progress, stage, message, done=None, total=None, bytes_done=None, bytes_total=None):
+    if progress is not None:
+        progress({
+            "stage": stage,
+            "message": message,
+            "done": done,
+            "total": total,
+            "bytes_done": bytes_done,
+            "bytes_total": bytes_total,
+        })
+
+
+def log(message, level=NOTICE):
+    if level >= log_level:
+        print(message, file=sys.stderr if level >= WARNING else sys.stdout)
+
+
+# Wall clock time per stage and counters (files, bytes, cache hits...) of
+# one import, plus the time and throughput of every media file converted
+# or copied. import_aaf writes it to timing_report.json.
+class ImportStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.files = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    # kind is "converted", "copied", "staged", "referenced" or "normalized".
+    # source_bytes is the size of the whole source, even when only a region
+    # of it was used. details (e.g. the formats a file was normalized from
+    # and to) are added to the file's record.
+    def add_file(self, name, kind, seconds, source_bytes, written_bytes, **details):
+        self.files.append(dict({
+            "name": name,
+            "kind": kind,
+            "seconds": seconds,
+            "source_bytes": source_bytes,
+            "written_bytes": written_bytes,
+            "mb_per_second": written_bytes / seconds / 1e6 if seconds else None,
+        }, **details))
+        self.count("files_" + kind)
+        self.count("source_bytes", source_bytes)
+        self.count("written_bytes", written_bytes)
+
+    def report(self):
+        return {
+            "version": 1,
+            "total_seconds": time.perf_counter() - self.started,
+            "stages": self.stages,
+            "counters": self.counters,
+            "files": self.files,
+        }
+
+    def summary(self):
+        return ", ".join("%s %.2fs" % (name, seconds) for name, seconds in self.stages.items())
+
+
+# For jobs run by MediaConverter: returns the result and the seconds taken.
+def timed_call(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+# Timeline model. Feature length conforms hold tens of thousands of items
+# and envelope points, so these use __slots__ instead of dicts. to_json and
+# from_json convert to and from the Audio_data_from_aaf.json layout, where
+# unset (None) attributes are left out.
+
+class EnvelopePoint:
+    __slots__ = ("time", "value")
+
+    def __init__(self, time, value):
+        self.time = time
+        self.value = value
+
+    def to_json(self):
+        return {"time": self.time, "value": self.value}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["time"], data["value"])
+
+
+# The points of an envelope, as two parallel arrays (NumPy arrays when
+# available). Offsetting, merging and writing out a heavily automated track
+# then works on whole arrays instead of one point object at a time.
+# Iterating yields EnvelopePoints.
+class Envelope:
+    __slots__ = ("times", "values")
+
+    def __init__(self, times=(), values=()):
+        if np is not None:
+            self.times = np.asarray(times, dtype=float)
+            self.values = np.asarray(values, dtype=float)
+        else:
+            # Floats either way: AAF values may be Fractions.
+            self.times = [float(time) for time in times]
+            self.values = [float(value) for value in values]
+
+    def __len__(self):
+        return len(self.times)
+
+    def __bool__(self):
+        return len(self.times) > 0
+
+    def __iter__(self):
+        for time, value in zip(self.time_list(), self.value_list()):
+            yield EnvelopePoint(time, value)
+
+    def time_list(self):
+        return self.times.tolist() if np is not None else self.times
+
+    def value_list(self):
+        return self.values.tolist() if np is not None else self.values
+
+    def shifted(self, offset):
+        if np is not None:
+            return Envelope(self.times + offset, self.values)
+        return Envelope([time + offset for time in self.times], self.values)
+
+    def scaled(self, scale, offset=0.0):
+        if np is not None:
+            return Envelope(self.times, self.values * scale + offset)
+        return Envelope(self.times, [value * scale + offset for value in self.values])
+
+    # keep is a sequence of booleans, one per point.
+    def select(self, keep):
+        if np is not None:
+            keep = np.asarray(keep, dtype=bool)
+            return Envelope(self.times[keep], self.values[keep])
+        return Envelope([time for time, kept in zip(self.times, keep) if kept],
+                        [value for value, kept in zip(self.values, keep) if kept])
+
+    def is_sorted(self):
+        if np is not None:
+            return bool(np.all(self.times[1:] >= self.times[:-1]))
+        return all(a <= b for a, b in zip(self.times, self.times[1:]))
+
+    # Points at the same time keep their order.
+    def sorted(self):
+        if self.is_sorted():
+            return self
+        if np is not None:
+            order = np.argsort(self.times, kind="stable")
+            return Envelope(self.times[order], self.values[order])
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        return Envelope([self.times[i] for i in order], [self.values[i] for i in order])
+
+    # Joins envelopes that are each sorted by time (e.g. the per-item runs
+    # of a track) into one sorted envelope, without a full re-sort.
+    @classmethod
+    def merge(cls, runs):
+        runs = [run for run in runs if run]
+        if not runs:
+            return cls()
+        if np is not None:
+            merged = cls(np.concatenate([run.times for run in runs]), np.concatenate([run.values for run in runs]))
+            # Usually the runs don't overlap and this is already sorted. If
+            # not, NumPy's stable sort (timsort) merges the sorted runs.
+            return merged.sorted()
+        runs = [run.sorted() for run in runs]
+        points = list(heapq.merge(*(zip(run.times, run.values) for run in runs), key=operator.itemgetter(0)))
+        return cls([point[0] for point in points], [point[1] for point in points])
+
+    @classmethod
+    def from_points(cls, points):
+        points = list(points)
+        return cls([point.time for point in points], [point.value for point in points])
+
+    def to_json(self):
+        return [{"time": time, "value": value} for time, value in zip(self.time_list(), self.value_list())]
+
+    @classmethod
+    def from_json(cls, points):
+        return cls([point["time"] for point in points], [point["value"] for point in points])
+
+
+class Item:
+    __slots__ = ("source", "offset", "position", "duration", "fadein", "fadeintype", "fadeout", "fadeouttype",
+                 "volume", "playbackrate", "channel", "volume_envelope", "panning_envelope")
+
+    def __init__(self, source=None, offset=None, position=None, duration=None):
+        self.source = source
+        self.offset = offset
+        self.position = position
+        self.duration = duration
+        self.fadein = None
+        self.fadeintype = None
+        self.fadeout = None
+        self.fadeouttype = None
+        self.volume = None
+        self.playbackrate = None
+        # Channel of a multichannel source the item plays, 1 based; None
+        # plays the source as it is.
+        self.channel = None
+        self.volume_envelope = None
+        self.panning_envelope = None
+
+    def to_json(self):
+        data = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if name.endswith("_envelope"):
+                value = value.to_json()
+            data[name] = value
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        item = cls()
+        for name in cls.__slots__:
+            if name in data:
+                value = data[name]
+                if name.endswith("_envelope"):
+                    value = Envelope.from_json(value)
+                setattr(item, name, value)
+        return item
+
+
+# track_id is the GUID the track is written to the Reaper project with
+# (see assign_track_ids), so later updates find it whatever it was renamed to.
+class Track:
+    __slots__ = ("name", "kind", "items", "panning", "volume_envelope", "panning_envelope", "track_id")
+
+    def __init__(self, name, kind, items=None):
+        self.name = name
+        self.kind = kind
+        self.items = items if items is not None else []
+        self.panning = None
+        self.volume_envelope = None
+        self.panning_envelope = None
+        self.track_id = None
+
+    def to_json(self):
+        data = {"name": self.name, "kind": self.kind}
+        if self.track_id is not None:
+            data["track_id"] = self.track_id
+        if self.panning is not None:
+            data["panning"] = self.panning
+        data["items"] = [item.to_json() for item in self.items]
+        if self.volume_envelope is not None:
+            data["volume_envelope"] = self.volume_envelope.to_json()
+        if self.panning_envelope is not None:
+            data["panning_envelope"] = self.panning_envelope.to_json()
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        track = cls(data.get("name", ""), data.get("kind", ""), [Item.from_json(item) for item in data.get("items", [])])
+        track.panning = data.get("panning")
+        track.track_id = data.get("track_id")
+        if "volume_envelope" in data:
+            track.volume_envelope = Envelope.from_json(data["volume_envelope"])
+        if "panning_envelope" in data:
+            track.panning_envelope = Envelope.from_json(data["panning_envelope"])
+        return track
+
+
+# A composition is {"tracks": [Track, ...], "markers": [dict, ...]}.
+def composition_to_json(data):
+    return {
+        "tracks": [track.to_json() for track in data.get("tracks", [])],
+        "markers": data.get("markers", []),
+    }
+
+
+def composition_from_json(data):
+    return {
+        "tracks": [Track.from_json(track) for track in data.get("tracks", [])],
+        "markers": data.get("markers", []),
+    }
+
+
+# The sidecar (Audio_data_from_aaf.json) holds the composition as imported.
+# "json" is compact and written a track at a time, "pretty" is indented
+# for reading by eye, and "msgpack" (needs the msgpack package) is the
+# quickest to load back.
+SIDECAR_EXTENSIONS = {
+    "json": ".json",
+    "pretty": ".json",
+    "msgpack": ".msgpack",
+}
+
+
+def iter_sidecar_json(data):
+    encoder = json.JSONEncoder(separators=(",", ":"))
+    yield '{"tracks":['
+    for i, track in enumerate(data.get("tracks", [])):
+        if i:
+            yield ","
+        yield from encoder.iterencode(track.to_json())
+    yield '],"markers":'
+    yield from encoder.iterencode(data.get("markers", []))
+    yield "}"
+
+
+# Writes the sidecar to base plus the format's extension and returns its
+# path. A sidecar left in another format by an earlier run is removed.
+def write_sidecar(data, base, sidecar_format="json", buffer_size=1024 * 1024):
+    if sidecar_format == "msgpack" and msgpack is None:
+        raise VeaperError("The msgpack sidecar format needs the msgpack package")
+    path = base + SIDECAR_EXTENSIONS[sidecar_format]
+    temp_path = path + ".tmp"
+    try:
+        if sidecar_format == "msgpack":
+            packer = msgpack.Packer()
+            tracks = data.get("tracks", [])
+            with open(temp_path, "wb", buffering=buffer_size) as file:
+                file.write(packer.pack_map_header(2))
+                file.write(packer.pack("tracks"))
+                file.write(packer.pack_array_header(len(tracks)))
+                for track in tracks:
+                    file.write(packer.pack(track.to_json()))
+                file.write(packer.pack("markers"))
+                file.write(packer.pack(data.get("markers", [])))
+        else:
+            with open(temp_path, "w", buffering=buffer_size) as file:
+                if sidecar_format == "pretty":
+                    json.dump(composition_to_json(data), file, indent=4)
+                else:
+                    file.writelines(iter_sidecar_json(data))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    for extension in set(SIDECAR_EXTENSIONS.values()):
+        if base + extension != path and os.path.isfile(base + extension):
+            os.remove(base + extension)
+    return path
+
+
+# Loads the sidecar written to base in any format, or returns None.
+def read_sidecar(base):
+    if os.path.isfile(base + ".msgpack") and msgpack is not None:
+        with open(base + ".msgpack", "rb") as file:
+            return composition_from_json(msgpack.unpackb(file.read(), raw=False))
+    if os.path.isfile(base + ".json"):
+        with open(base + ".json", "r") as file:
+            return composition_from_json(json.load(file))
+    return None
+
+
+# Drops points that carry no information: exact repeats, and points in the
+# middle of a flat run (e.g. the 1.0 guard points collect_vol_pan_automation
+# adds around adjacent items without automation). Lossless.
+def drop_redundant_points(envelope):
+    times, values = envelope.times, envelope.values
+    if np is not None:
+        repeat = np.zeros(len(times), dtype=bool)
+        repeat[1:] = (times[1:] == times[:-1]) & (values[1:] == values[:-1])
+        envelope = envelope.select(~repeat)
+        values = envelope.values
+        flat = np.zeros(len(values), dtype=bool)
+        flat[1:-1] = (values[1:-1] == values[:-2]) & (values[1:-1] == values[2:])
+        return envelope.select(~flat)
+
+    kept = []
+    for i in range(len(times)):
+        if kept and times[kept[-1]] == times[i] and values[kept[-1]] == values[i]:
+            continue
+        if len(kept) >= 2 and values[kept[-2]] == values[kept[-1]] == values[i]:
+            kept[-1] = i
+            continue
+        kept.append(i)
+    return Envelope([times[i] for i in kept], [values[i] for i in kept])
+
+
+def to_db(values):
+    if np is not None:
+        return 20 * np.log10(np.maximum(values, 1e-8))
+    return [20 * math.log10(max(value, 1e-8)) for value in values]
+
+
+# Ramer-Douglas-Peucker on an envelope. The error of a point is how far the
+# line between the segment's ends passes from it at the same time, in dB
+# if db is set (the line itself is still straight in amplitude, as Reaper
+# draws it). Points on either side of a jump (two points at the same time)
+# are always kept.
+def simplify_envelope(envelope, tolerance, db=False):
+    if len(envelope) < 3:
+        return envelope
+
+    times, values = envelope.times, envelope.values
+    if np is not None:
+        jump = times[1:] == times[:-1]
+        keep = np.zeros(len(envelope), dtype=bool)
+        keep[1:] |= jump
+        keep[:-1] |= jump
+        keep[0] = keep[-1] = True
+        anchors = np.flatnonzero(keep).tolist()
+    else:
+        keep = [False] * len(envelope)
+        keep[0] = keep[-1] = True
+        for i in range(1, len(envelope)):
+            if times[i] == times[i - 1]:
+                keep[i] = keep[i - 1] = True
+        anchors = [i for i, kept in enumerate(keep) if kept]
+    measured = to_db(values) if db else values
+
+    stack = [(a, b) for a, b in zip(anchors, anchors[1:]) if b - a > 1]
+    while stack:
+        start, end = stack.pop()
+        t0, t1 = times[start], times[end]
+        v0, v1 = values[start], values[end]
+        if np is not None:
+            inner = slice(start + 1, end)
+            line = v0 + (v1 - v0) * (times[inner] - t0) / (t1 - t0)
+            errors = np.abs(measured[inner] - (to_db(line) if db else line))
+            worst = int(np.argmax(errors))
+            worst_error = errors[worst]
+        else:
+            worst, worst_error = 0, -1.0
+            for i in range(start + 1, end):
+                line = v0 + (v1 - v0) * (times[i] - t0) / (t1 - t0)
+                error = abs(measured[i] - (to_db([line])[0] if db else line))
+                if error > worst_error:
+                    worst, worst_error = i - start - 1, error
+        if worst_error > tolerance:
+            middle = start + 1 + worst
+            keep[middle] = True
+            if middle - start > 1:
+                stack.append((start, middle))
+            if end - middle > 1:
+                stack.append((middle, end))
+
+    return envelope.select(keep)
+
+
+# Optional thinning of the track envelopes of a composition.
+def thin_envelopes(data, volume_tolerance=VOLUME_TOLERANCE_DB, pan_tolerance=PAN_TOLERANCE):
+    before = after = 0
+    for track in data.get("tracks", []):
+        for name, tolerance, db in (("volume_envelope", volume_tolerance, True),
+                                    ("panning_envelope", pan_tolerance, False)):
+            envelope = getattr(track, name)
+            if not envelope:
+                continue
+            thinned = drop_redundant_points(envelope.sorted())
+            if tolerance:
+                thinned = simplify_envelope(thinned, tolerance, db)
+            before += len(envelope)
+            after += len(thinned)
+            setattr(track, name, thinned)
+    if before:
+        log("Thinned envelopes from %d to %d points." % (before, after))
+    return data
+
+
 class AAFInterface:
 
-    def __init__(self, myDirectory):
+    # Linked media is looked up in the AAF's folder and in search_paths,
+    # subfolders included, through media_index if given (shared between
+    # imports, see MediaIndex) or an index of its own. Picture slots and
+    # the video they link to are skipped unless include_video is set, as
+    # Reaper projects only get the audio. split_channels extracts
+    # multichannel embedded essence to one mono WAV per channel. With peaks,
+    # every extracted WAV gets its REAPER peak file (see veaperPeaks).
+    def __init__(self, myDirectory, chunk_size=ESSENCE_CHUNK_SIZE, search_paths=None, include_video=False,
+                 split_channels=False, peaks=False, media_index=None):
         self.aaf = None
         self.encoder = ""
         self.aaf_directory = myDirectory
-        self.essence_data = {}
-
-    def open(self, filename):
+        self.mob_index = {}
+        self.compositions = []
+        self.chunk_size = chunk_size
+        self.bytes_extracted = 0
+        self.files_extracted = 0
+        self.search_paths = search_paths or []
+        self.media_index = media_index
+        self.include_video = include_video
+        self.split_channels = split_channels
+        self.peaks = peaks
+        self.filename = None
+        self.shared_paths = set()
+
+    # scan_media=False skips indexing the media folders, for callers that
+    # set the essence paths themselves.
+    def open(self, filename, scan_media=True):
         try:
             self.aaf = aaf2.open(filename, "r")
         except Exception:
-            print("Could not open AAF file.", ERROR)
+            log("Could not open AAF file.", ERROR)
             return False
         try:
             self.encoder = self.aaf.header["IdentificationList"][0]["ProductName"].value
         except Exception:
-            print("Unable to find file encoder", WARNING)
+            log("Unable to find file encoder", WARNING)
         self.aaf_directory = os.path.abspath(os.path.dirname(filename))
-        self.essence_data = {}
+        self.filename = filename
+        if scan_media:
+            if self.media_index is None:
+                self.media_index = MediaIndex([self.aaf_directory] + list(self.search_paths))
+            else:
+                for root in [self.aaf_directory] + list(self.search_paths):
+                    self.media_index.add_root(root)
+        self.build_index()
         return True
 
-    def build_wav(self, fname, data, depth, rate, channels=2):
+    def read_chunks(self, stream):
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            self.bytes_extracted += len(chunk)
+            yield chunk
+
+    # chunks is any iterable of raw PCM byte strings.
+    def build_wav(self, fname, chunks, depth, rate, channels=2):
+        peaks = PeakBuilder(channels, int(depth / 8), rate) if self.peaks else None
         with wave.open(fname, "wb") as f:
-            print(rate)
             f.setnchannels(channels)
             f.setsampwidth(int(depth / 8))
             f.setframerate(rate)
-            f.writeframesraw(data)
+            for chunk in chunks:
+                f.writeframesraw(chunk)
+                if peaks is not None:
+                    peaks.add(chunk)
             global sampleRateFicheiro
             sampleRateFicheiro = rate
             f.close()
+        if peaks is not None:
+            peaks.write(fname)
+
+    # Like build_wav, but writes each channel of the interleaved chunks to
+    # its own mono file, fnames being one name per channel.
+    def build_channel_wavs(self, fnames, chunks, depth, rate):
+        width = int(depth / 8)
+        block_align = width * len(fnames)
+        peaks = [PeakBuilder(1, width, rate) for _ in fnames] if self.peaks else []
+        with contextlib.ExitStack() as stack:
+            files = [stack.enter_context(wave.open(fname, "wb")) for fname in fnames]
+            for f in files:
+                f.setnchannels(1)
+                f.setsampwidth(width)
+                f.setframerate(rate)
+            rest = b""
+            for chunk in chunks:
+                data = rest + chunk if rest else chunk
+                usable = len(data) - len(data) % block_align
+                rest = data[usable:]
+                for index, channel_data in enumerate(deinterleave(data, len(fnames), width, usable)):
+                    files[index].writeframesraw(channel_data)
+                    if peaks:
+                        peaks[index].add(channel_data)
+        for fname, builder in zip(fnames, peaks):
+            builder.write(fname)
 
     def aafrational_value(self, rational):
         return rational.numerator / rational.denominator
 
     def get_point_list(self, varying, duration):
-        data = []
-        for point in varying["PointList"]:
-            data.append({
-                "time": point.time * duration,
-                "value": point.value
-            })
-        return data
+        points = list(varying["PointList"])
+        return Envelope([point.time * duration for point in points], [point.value for point in points])
 
     def get_linked_essence(self, mob):
         try:
-            url = mob.descriptor.locator.pop()["URLString"].value
-            # file:///C%3a/Users/user/My%20video.mp4
-            url = urllib.parse.urlparse(url)
-            url = url.netloc + url.path
-            # /C%3a/Users/user/My%20video.mp4
-            url = urllib.parse.unquote(url)
-            # /C:/Users/user/My video.mp4
-            url = urllib.request.url2pathname(url)
-            # C:\\Users\\user\\My video.mp4
+            url = locator_path(mob)
 
             # If the AAF was built on another computer,
             # chances are the paths will differ.
-            # Typically the source files are in the same directory as the AAF.
-            if not os.path.isfile(url):
-                local = os.path.join(self.aaf_directory, os.path.basename(url))
-                if os.path.isfile(local):
-                    url = local
-            return url
+            # Typically the source files are near the AAF, so look there
+            # first, by name or, failing that, by the MobID of the file.
+            found = self.media_index.find(url, mob.mob_id) if self.media_index else None
+            return found or url
 
         except Exception:
-            print("Error retrieving file url for %s" % mob.name, WARNING)
+            log("Error retrieving file url for %s" % mob.name, WARNING)
             return ""
 
-    def extract_embedded_essence(self, mob, filename):
-        print("Extracting essence %s..." % filename)
-        stream = mob.essence.open()
-        data = stream.read()
-        stream.close()
+    # filename may be a list of names, one per channel, to split PCM
+    # essence into mono files.
+    def extract_embedded_essence(self, mob, filename, descriptor=None):
+        log("Extracting essence %s..." % filename)
+        if descriptor is None:
+            descriptor = self.read_descriptor(mob)
 
-        meta = mob.descriptor
-        data_fmt = meta["ContainerFormat"].value.name if "ContainerFormat" in meta else ""
-        if data_fmt == "MXF":
-            sample_depth = meta["QuantizationBits"].value
-            sample_rate = meta["SampleRate"].value
-            sample_rate = self.aafrational_value(sample_rate)
-            self.build_wav(filename, data, sample_depth, sample_rate)
-        else:
-            with open(filename, "wb") as f:
-                f.write(data)
-                f.close()
+        stream = mob.essence.open()
+        try:
+            if isinstance(filename, list):
+                self.build_channel_wavs(filename, self.read_chunks(stream), descriptor["depth"], descriptor["rate"])
+            elif descriptor["pcm"]:
+                self.build_wav(filename, self.read_chunks(stream), descriptor["depth"], descriptor["rate"],
+                               descriptor["channels"] or 2)
+            else:
+                with open(filename, "wb") as f:
+                    for chunk in self.read_chunks(stream):
+                        f.write(chunk)
+        finally:
+            stream.close()
 
         return filename
 
-    def extract_essence(self, target, callback):
+    def find_source_mob(self, segment):
+        if isinstance(segment, aaf2.components.Sequence):
+            for component in segment.components:
+                if isinstance(component, aaf2.components.SourceClip):
+                    return component.mob
+            return None
+        elif isinstance(segment, aaf2.components.SourceClip):
+            return segment.mob
+        return None
+
+    def read_descriptor(self, mob):
+        meta = mob.descriptor
+        descriptor = {
+            "container": meta["ContainerFormat"].value.name if "ContainerFormat" in meta else "",
+            "rate": None,
+            "depth": None,
+            "channels": None,
+            # Raw PCM samples, which need a WAV header. Other essence
+            # (e.g. WAVE or AIFC descriptors) is a whole file already.
+            "pcm": False,
+        }
+        try:
+            if "SampleRate" in meta:
+                descriptor["rate"] = self.aafrational_value(meta["SampleRate"].value)
+            if "QuantizationBits" in meta:
+                descriptor["depth"] = meta["QuantizationBits"].value
+            if "Channels" in meta:
+                descriptor["channels"] = meta["Channels"].value
+            descriptor["pcm"] = descriptor["container"] == "MXF" or meta.classdef.class_name == "PCMDescriptor"
+        except Exception:
+            log("Could not read the essence descriptor of %s" % mob.name, WARNING)
+        return descriptor
+
+    # Walks the master mobs once and indexes every slot by (MobID, slot id),
+    # so nothing has to walk the object graph again, and clips are matched
+    # to their essence by MobID rather than by (possibly duplicate) name.
+    #
+    # Slots of one master mob on the same source mob are the channels of its
+    # (poly) essence; each gets its channel number, from the slot's
+    # PhysicalTrackNumber or else its order.
+    def build_index(self):
+        self.mob_index = {}
         for master_mob in self.aaf.content.mastermobs():
-            self.essence_data[master_mob.name] = {}
+            slots_by_source = {}
             for slot in master_mob.slots:
-                source_mob = None
-
-                if isinstance(slot.segment, aaf2.components.Sequence):
-                    source_mob = None
-                    for component in slot.segment.components:
-                        if isinstance(component, aaf2.components.SourceClip):
-                            source_mob = component.mob
-                            break
-                    else:
-                        self.essence_data[master_mob.name][slot.slot_id] = ""
-                        print("Cannot find essence for %s slot %d" % (master_mob.name, slot.slot_id), WARNING)
-                elif isinstance(slot.segment, aaf2.components.SourceClip):
-                    source_mob = slot.segment.mob
-
-                if slot.segment.media_kind == "Picture":
-                    # Video files cannot be embedded in the AAF.
-                    self.essence_data[master_mob.name][slot.slot_id] = self.get_linked_essence(source_mob)
+                segment = slot.segment
+                if segment.media_kind == "Picture" and not self.include_video:
                     continue
+                source_mob = self.find_source_mob(segment)
                 if source_mob is None:
+                    if isinstance(segment, aaf2.components.Sequence):
+                        log("Cannot find essence for %s slot %d" % (master_mob.name, slot.slot_id), WARNING)
+                        self.mob_index[(master_mob.mob_id, slot.slot_id)] = {
+                            "name": master_mob.name + slot.name,
+                            "kind": segment.media_kind,
+                            "source_mob": None,
+                            "embedded": False,
+                            "descriptor": None,
+                            "channel": None,
+                            "path": "",
+                        }
                     continue
-                if source_mob.essence:
-                    filename = os.path.join(target, master_mob.name + slot.name + ".wav")
-                    if callback:
-                        callback("Extracting %s..." % (master_mob.name + slot.name + ".wav"))
-                    self.essence_data[master_mob.name][slot.slot_id] = self.extract_embedded_essence(source_mob, filename)
-                else:
-                    self.essence_data[master_mob.name][slot.slot_id] = self.get_linked_essence(source_mob)
 
-    def get_essence_file(self, mob_name, slot_id):
-        try:
-            return self.essence_data[mob_name][slot_id]
-        except Exception:
-            print("Cannot find essence for %s slot %d" % (mob_name, slot_id), WARNING)
+                embedded = segment.media_kind != "Picture" and bool(source_mob.essence)
+                self.mob_index[(master_mob.mob_id, slot.slot_id)] = {
+                    "name": master_mob.name + slot.name,
+                    "kind": segment.media_kind,
+                    "source_mob": source_mob,
+                    "embedded": embedded,
+                    "descriptor": self.read_descriptor(source_mob) if embedded else None,
+                    "channel": None,
+                    "path": None,
+                }
+                slots_by_source.setdefault(source_mob.mob_id, []).append(slot)
+
+            for slots in slots_by_source.values():
+                if len(slots) < 2:
+                    continue
+                for number, slot in enumerate(slots, 1):
+                    if "PhysicalTrackNumber" in slot:
+                        number = slot["PhysicalTrackNumber"].value or number
+                    self.mob_index[(master_mob.mob_id, slot.slot_id)]["channel"] = number
+        self.compositions = list(self.aaf.content.compositionmobs())
+
+    # callback gets progress events (see report_progress). Given a converter
+    # with more than one worker, embedded essence is extracted in parallel,
+    # each worker reading its share through its own handle to the AAF.
+    def extract_essence(self, target, callback, converter=None):
+        # Slots sharing a source mob (the channels of poly essence) share
+        # its extracted files.
+        groups = {}
+        for key, entry in self.mob_index.items():
+            if entry["path"] is not None:
+                continue
+            if not entry["embedded"]:
+                # Video files cannot be embedded in the AAF.
+                entry["path"] = self.get_linked_essence(entry["source_mob"])
+                continue
+            groups.setdefault(entry["source_mob"].mob_id, []).append(key)
+
+        pending = []
+        used_names = set()
+        for keys in groups.values():
+            entry = self.mob_index[keys[0]]
+            name = entry["name"]
+            if name in used_names:
+                # Two master mobs with the same name; keep both.
+                name += "_%s" % str(entry["source_mob"].mob_id)[-8:]
+            used_names.add(name)
+            pending.append((keys[0],) + self.plan_extraction(keys, os.path.join(target, name)))
+
+        total = len(pending)
+        self.files_extracted += sum(len(files) for _, files, _ in pending)
+        if converter is not None and converter.workers > 1 and len(pending) > 1:
+            self.extract_in_workers(pending, converter, callback, total)
+            return
+        for done, (key, files, paths) in enumerate(pending):
+            entry = self.mob_index[key]
+            report_progress(callback, "extract", "Extracting %s..." % os.path.basename(files[0]), done, total,
+                            self.bytes_extracted)
+            self.extract_embedded_essence(entry["source_mob"], files if len(files) > 1 else files[0],
+                                          entry["descriptor"])
+            self.set_paths(paths)
+
+    # Returns the files the essence of the slots keys goes to, and the file
+    # of each slot: one WAV, or with split_channels one mono WAV per channel
+    # when every slot has its channel (see build_index).
+    def plan_extraction(self, keys, base):
+        entries = [self.mob_index[key] for key in keys]
+        descriptor = entries[0]["descriptor"]
+        channels = descriptor["channels"] or 0
+        if self.split_channels and channels > 1 and descriptor["pcm"] \
+                and all(entry["channel"] and entry["channel"] <= channels for entry in entries):
+            files = ["%s_%d.wav" % (base, channel) for channel in range(1, channels + 1)]
+            return files, {key: files[entry["channel"] - 1] for key, entry in zip(keys, entries)}
+        files = [base + ".wav"]
+        return files, dict.fromkeys(keys, files[0])
+
+    def set_paths(self, paths):
+        for key, path in paths.items():
+            self.mob_index[key]["path"] = path
+
+    # pending is [(mob_index key, files, paths)] (see plan_extraction),
+    # split into disjoint batches, a few per worker so the load evens out
+    # (see extract_essence_batch).
+    def extract_in_workers(self, pending, converter, callback, total):
+        batch_count = min(len(pending), converter.workers * EXTRACT_BATCHES_PER_WORKER)
+        batches = [pending[start::batch_count] for start in range(batch_count)]
+        jobs = []
+        for index, batch in enumerate(batches):
+            files = [(self.mob_index[key]["source_mob"].mob_id, names if len(names) > 1 else names[0],
+                      self.mob_index[key]["descriptor"])
+                     for key, names, _ in batch]
+            jobs.append((index, extract_essence_batch, (self.filename, files, self.chunk_size, self.peaks)))
+
+        done = 0
+        report_progress(callback, "extract", "Extracting %d files..." % len(pending), done, total,
+                        self.bytes_extracted)
+        for index, bytes_read, error in converter.run(jobs):
+            if error is not None:
+                raise VeaperError("Failed to extract embedded essence: %s" % error)
+            for _, _, paths in batches[index]:
+                self.set_paths(paths)
+            self.bytes_extracted += bytes_read
+            done += len(batches[index])
+            report_progress(callback, "extract", "Extracted %d of %d files" % (done, len(pending)), done, total,
+                            self.bytes_extracted)
+
+    def get_essence_file(self, mob_id, slot_id):
+        entry = self.mob_index.get((mob_id, slot_id))
+        if entry is None or entry["path"] is None:
+            log("Cannot find essence for %s slot %d" % (mob_id, slot_id), WARNING)
             return ""
+        return entry["path"]
 
-    def get_embedded_essence_count(self):
-        count = 0
-        for master_mob in self.aaf.content.mastermobs():
-            for slot in master_mob.slots:
-                if isinstance(slot.segment, aaf2.components.Sequence):
-                    source_mob = None
-                    for component in slot.segment.components:
-                        if isinstance(component, aaf2.components.SourceClip):
-                            source_mob = component.mob
-                            break
-                    else:
-                        continue
-                elif isinstance(slot.segment, aaf2.components.SourceClip):
-                    source_mob = slot.segment.mob
-                if slot.segment.media_kind == "Sound" and source_mob.essence:
-                    count += 1
-        return count
+    # The channel the slot plays of its file, when the file holds the other
+    # channels of its poly essence too (not split, see plan_extraction).
+    def get_essence_channel(self, mob_id, slot_id):
+        entry = self.mob_index.get((mob_id, slot_id))
+        if entry is None or entry["path"] not in self.shared_paths:
+            return None
+        return entry["channel"]
 
 
     # Instead of using per-item volume curves (aka take volume envelope),
     # we collect data from items and "render" it to the track volume envelope.
     def collect_vol_pan_automation(self, track):
-        envelopes = {
-            "volume_envelope": [],
-            "panning_envelope": []
-        }
-        for envelope in envelopes:
-            for item in track["items"]:
-                if envelope in item:
-                    for point in item[envelope]:
-                        envelopes[envelope].append({
-                            "time": item["position"] + point["time"],
-                            "value": point["value"]
-                        })
-                    del item[envelope]
+        # Each item contributes a run of points that is already sorted, so
+        # the track envelope is a merge of the runs, not a sort.
+        for envelope in ("volume_envelope", "panning_envelope"):
+            runs = []
+            for item in track.items:
+                item_points = getattr(item, envelope)
+                if item_points is not None:
+                    if item_points:
+                        runs.append(item_points.shifted(item.position))
+                    setattr(item, envelope, None)
                 else:
-                    if not envelopes[envelope]: continue
+                    if not runs: continue
                     # We don't want items without automation to be affected
                     # by automation added by other items
-                    envelopes[envelope].append({
-                        "time": item["position"],
-                        "value": 1.0
-                    })
-                    envelopes[envelope].append({
-                        "time": item["position"] + item["duration"],
-                        "value": 1.0
-                    })
-
-        # Add only if not empty
-        if envelopes["volume_envelope"]:
-            track["volume_envelope"] = envelopes["volume_envelope"]
-        if envelopes["panning_envelope"]:
-            track["panning_envelope"] = envelopes["panning_envelope"]
+                    runs.append(Envelope([item.position, item.position + item.duration], [1.0, 1.0]))
+
+            # Add only if not empty
+            merged = Envelope.merge(runs)
+            if merged:
+                setattr(track, envelope, merged)
 
         return track
 
@@ -206,9 +962,11 @@ class AAFInterface:
     # It is supposed to gather whatever information it can and pass it to
     # its caller, who will append the new data to its own.
     # The topmost caller sets "position" and "duration", as well as fades,
-    def parse_operation_group(self, group, edit_rate):
+    # and passes in the Item that every level fills in.
+    def parse_operation_group(self, group, edit_rate, item=None):
 
-        item = {}
+        if item is None:
+            item = Item()
 
         # We could base volume envelope extraction on either group.operation.name
         # or group.parameters[].name depending on which is more prone to be constant.
@@ -218,18 +976,15 @@ class AAFInterface:
             for p in group.parameters:
                 if p.name not in ["Amplitude", "Amplitude multiplier", "Level"]: continue
                 if isinstance(p, aaf2.misc.VaryingValue):
-                    item["volume_envelope"] = self.get_point_list(p, group.length / edit_rate)
+                    item.volume_envelope = self.get_point_list(p, group.length / edit_rate)
                 elif isinstance(p, aaf2.misc.ConstantValue):
-                    item["volume"] = self.aafrational_value(p.value)
+                    item.volume = self.aafrational_value(p.value)
 
         if group.operation.name == "Mono Audio Pan":
             for p in group.parameters:
                 points = self.get_point_list(p, group.length / edit_rate)
                 if p.name == "Pan value":
-                    item["panning_envelope"] = [{
-                        "time": point["time"],
-                        "value": point["value"] * -2 + 1
-                    } for point in points]
+                    item.panning_envelope = points.scaled(-2, 1)
 
         if group.operation.name == "Audio Effect":
             for p in group.parameters:
@@ -239,7 +994,7 @@ class AAFInterface:
                     # since the parameter name is blank.
                     pass
                 if p.name == "SpeedRatio":
-                    item["playbackrate"] = self.aafrational_value(p.value)
+                    item.playbackrate = self.aafrational_value(p.value)
 
         segment = group.segments[0]
 
@@ -248,12 +1003,11 @@ class AAFInterface:
             segment = segment.components[0]
 
         if isinstance(segment, aaf2.components.OperationGroup):
-            item.update(self.parse_operation_group(segment, edit_rate))
+            self.parse_operation_group(segment, edit_rate, item)
         elif isinstance(segment, aaf2.components.SourceClip):
-            item.update({
-                "source": self.get_essence_file(segment.mob.name, segment.slot_id),
-                "offset": segment.start / edit_rate,
-            })
+            item.source = self.get_essence_file(segment.mob_id, segment.slot_id)
+            item.channel = self.get_essence_channel(segment.mob_id, segment.slot_id)
+            item.offset = segment.start / edit_rate
 
         return item
 
@@ -269,36 +1023,30 @@ class AAFInterface:
                 duration = component.length / edit_rate
 
                 if isinstance(component, aaf2.components.SourceClip):
-                    item = {
-                        "source": self.get_essence_file(component.mob.name, component.slot_id),
-                        "offset": component.start / edit_rate,
-                        "position": time,
-                        "duration": duration,
-                    }
+                    item = Item(self.get_essence_file(component.mob_id, component.slot_id),
+                                component.start / edit_rate, time, duration)
+                    item.channel = self.get_essence_channel(component.mob_id, component.slot_id)
                     if fade == 1:
-                        item["fadein"] = fade_length
-                        item["fadeintype"] = fade_type
+                        item.fadein = fade_length
+                        item.fadeintype = fade_type
                     fade = 0
                     items.append(item)
                     time += duration
 
                 elif isinstance(component, aaf2.components.OperationGroup):
-                    item = {
-                        "position": time,
-                        "duration": duration
-                    }
-                    item.update(self.parse_operation_group(component, edit_rate))
+                    item = Item(position=time, duration=duration)
+                    self.parse_operation_group(component, edit_rate, item)
                     if fade == 1:
-                        item["fadein"] = fade_length
-                        item["fadeintype"] = fade_type
+                        item.fadein = fade_length
+                        item.fadeintype = fade_type
                     fade = 0
 
-                    if "source" not in item:
-                        print("Failed to find item source at %f seconds." % time, WARNING)
-                        item["source"] = ""
-                    if "offset" not in item:
-                        print("Failed to find item offset at %f seconds." % time, WARNING)
-                        item["offset"] = 0
+                    if item.source is None:
+                        log("Failed to find item source at %f seconds." % time, WARNING)
+                        item.source = ""
+                    if item.offset is None:
+                        log("Failed to find item offset at %f seconds." % time, WARNING)
+                        item.offset = 0
 
                     items.append(item)
                     time += duration
@@ -312,8 +1060,8 @@ class AAFInterface:
                     except Exception:
                         pass
                     if fade == 0:
-                        items[-1]["fadeout"] = fade_length
-                        items[-1]["fadeouttype"] = fade_type
+                        items[-1].fadeout = fade_length
+                        items[-1].fadeouttype = fade_type
                     if fade != 1:
                         fade = 1
                     time -= duration
@@ -323,7 +1071,7 @@ class AAFInterface:
                     time += duration
 
             except Exception:
-                print("Failed to parse component at %f seconds." % time)
+                log("Failed to parse component at %f seconds." % time, WARNING)
 
         return items
 
@@ -335,34 +1083,23 @@ class AAFInterface:
             for sequence in slot.segment.slots.value:
                 seq_data = self.parse_sequence(sequence, edit_rate)
                 if seq_data:
-                    data.append({
-                        "name": "",
-                        "kind": "picture",
-                        "items": seq_data
-                    })
+                    data.append(Track("", "picture", seq_data))
         elif isinstance(slot.segment, aaf2.components.Sequence):
             seq_data = self.parse_sequence(slot.segment, edit_rate)
             if seq_data:
-                data.append({
-                    "name": slot.name,
-                    "kind": "picture",
-                    "items": seq_data
-                })
+                data.append(Track(slot.name, "picture", seq_data))
 
         return data
 
     def get_sound_track(self, slot):
-        data = {
-            "name": slot.name,
-            "kind": "sound",
-        }
+        data = Track(slot.name, "sound")
         edit_rate = self.aafrational_value(slot.edit_rate)
         segment = slot.segment
         if isinstance(segment, aaf2.components.OperationGroup):
             # Maybe we should check for segment.operation.name as well?
             for p in segment.parameters:
                 if p.name == "Pan value":
-                    data["panning"] = self.aafrational_value(p.value) * 2 - 1
+                    data.panning = self.aafrational_value(p.value) * 2 - 1
                 if p.name in ["Pan", "Pan Level"]:
                     # Sometimes segment.length is wrong so we have to use
                     # the length of the data segment instead.
@@ -370,14 +1107,11 @@ class AAFInterface:
                     if self.encoder == "DaVinci Resolve":
                         real_length = segment.segments[0].length / edit_rate
                     points = self.get_point_list(p, real_length)
-                    data["panning_envelope"] = [{
-                        "time": point["time"],
-                        "value": point["value"] * -2 + 1
-                        # Reaper can't make up its mind 
-                    } for point in points]
-            data["items"] = self.parse_sequence(segment.segments[0], edit_rate)
+                    # Reaper can't make up its mind
+                    data.panning_envelope = points.scaled(-2, 1)
+            data.items = self.parse_sequence(segment.segments[0], edit_rate)
         elif isinstance(segment, aaf2.components.Sequence):
-            data["items"] = self.parse_sequence(segment, edit_rate)
+            data.items = self.parse_sequence(segment, edit_rate)
         return data
 
     def get_markers(self, slot):
@@ -399,7 +1133,7 @@ class AAFInterface:
         return markers
 
     def get_composition_list(self):
-        return [composition.name for composition in self.aaf.content.compositionmobs()]
+        return [composition.name for composition in self.compositions]
 
     def get_composition(self, composition):
         data = {
@@ -407,21 +1141,32 @@ class AAFInterface:
             "markers": []
         }
 
-        for slot in list(self.aaf.content.compositionmobs())[composition].slots:
+        # Files more than one slot plays from, each its own channel.
+        paths = set()
+        self.shared_paths = set()
+        for entry in self.mob_index.values():
+            if entry["channel"] and entry["path"]:
+                if entry["path"] in paths:
+                    self.shared_paths.add(entry["path"])
+                paths.add(entry["path"])
+
+        for slot in self.compositions[composition].slots:
             try:
                 if slot.media_kind == "Picture":
+                    if not self.include_video:
+                        continue
                     picture_tracks = self.get_picture_tracks(slot)
                     if picture_tracks:
                         data["tracks"] += picture_tracks
                 elif slot.media_kind in ["Sound", "LegacySound"]:
                     track_data = self.get_sound_track(slot)
-                    track_data["kind"] = "sound"
+                    track_data.kind = "sound"
                     track_data = self.collect_vol_pan_automation(track_data)
                     data["tracks"].append(track_data)
                 elif slot.media_kind == "DescriptiveMetadata":
                     data["markers"] += self.get_markers(slot)
             except Exception:
-                print("Failed parsing slot %s" % slot.name, WARNING)
+                log("Failed parsing slot %s" % slot.name, WARNING)
         return data
 
     def get_aaf_metadata(self):
@@ -435,20 +1180,237 @@ class AAFInterface:
                 "platform": identity["Platform"].value
             }
         except Exception:
-            print("Could not get file identity metadata.", WARNING)
+            log("Could not get file identity metadata.", WARNING)
             return {}
 
+# The path in the locator of a source mob linking to its essence.
+def locator_path(mob):
+    url = mob.descriptor.locator.pop()["URLString"].value
+    # file:///C%3a/Users/user/My%20video.mp4
+    url = urllib.parse.urlparse(url)
+    url = url.netloc + url.path
+    # /C%3a/Users/user/My%20video.mp4
+    url = urllib.parse.unquote(url)
+    # /C:/Users/user/My video.mp4
+    url = urllib.request.url2pathname(url)
+    # C:\\Users\\user\\My video.mp4
+    return url
+
+
+# The media files an AAF links to, as (path in the AAF, MobID) pairs to
+# look up with MediaIndex.find, without extracting or reading anything
+# else. Raises VeaperError if the AAF can't be opened.
+def read_linked_media(filename):
+    aaf_interface = AAFInterface(os.path.dirname(filename))
+    try:
+        aaf_interface.aaf = aaf2.open(filename, "r")
+    except Exception:
+        raise VeaperError("Could not open AAF file %s" % filename)
+    try:
+        aaf_interface.build_index()
+        media = {}
+        for entry in aaf_interface.mob_index.values():
+            if entry["source_mob"] is None or entry["embedded"]:
+                continue
+            try:
+                media.setdefault(locator_path(entry["source_mob"]), entry["source_mob"].mob_id)
+            except Exception:
+                continue
+        return list(media.items())
+    finally:
+        aaf_interface.aaf.close()
+
+
 def new_eguid():
     return "{" + str(uuid.uuid4()).upper() + "}"
 
 
 def get_audio_tracks(data):
-    return [track for track in data.get("tracks", []) if track.get("kind") == "sound"]
+    return [track for track in data.get("tracks", []) if track.kind == "sound"]
+
+
+# MobIDs and MXF package UIDs are both SMPTE UMIDs, but an AAF stores the
+# material number half of a MobID as a little endian AUID. Keys are the hex
+# of the big endian form.
+def mob_id_key(mob_id):
+    try:
+        raw = mob_id.bytes_le
+    except AttributeError:
+        return None
+    material = raw[16:]
+    material = material[3::-1] + material[5:3:-1] + material[7:5:-1] + material[8:]
+    return (raw[:16] + material).hex()
+
+
+def umid_keys(uid):
+    # Material numbers that are ULs are stored with their halves swapped.
+    return [uid.hex(), (uid[:16] + uid[24:] + uid[16:24]).hex()]
+
+
+# Every file under roots, skipping hidden folders and our own output, as
+# (paths, {lower case file name: paths}).
+def walk_media_folders(roots):
+    paths = set()
+    by_name = {}
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith(".") and d != "Reaper_from_DaVinci")
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                if path not in paths:
+                    paths.add(path)
+                    by_name.setdefault(filename.lower(), []).append(path)
+    return paths, by_name
+
+
+def is_inside(path, folder):
+    return path == folder or path.startswith(folder.rstrip(os.sep) + os.sep)
+
+
+# Every file under a list of folders, scanned once, so media can be found
+# by lookup instead of probing the filesystem for every source. MXF files
+# can also be found by their package UMID (the MobID the AAF refers to
+# them by); those are only read from the files if a lookup by name fails.
+#
+# One index can serve many imports, from several threads: each adds the
+# folder of its AAF with add_root, which scans only folders not indexed
+# yet. A lookup that finds nothing rescans the folders in case the media
+# arrived since, at most once per MEDIA_RESCAN_INTERVAL, backing off while
+# the media stays missing. Folders are walked outside the lock, so lookups
+# never wait for a walk.
+class MediaIndex:
+
+    def __init__(self, roots=()):
+        self.roots = []
+        self.paths = set()
+        self.by_name = {}
+        # {path: (mtime, UMID keys)} of the MXF files read so far.
+        self.umids = {}
+        self.by_umid = None
+        # Time spent walking folders and reading MXF headers.
+        self.scan_seconds = 0.0
+        self.scanned_at = 0.0
+        self.rescan_interval = MEDIA_RESCAN_INTERVAL
+        self.rescanning = False
+        self.lock = threading.RLock()
+        for root in roots:
+            self.add_root(root, scan=False)
+        self.scan()
+
+    # Indexes root too, unless it is inside a folder indexed already.
+    def add_root(self, root, scan=True):
+        root = os.path.abspath(root)
+        with self.lock:
+            if not os.path.isdir(root) or any(is_inside(root, known) for known in self.roots):
+                return
+            # Folders inside root are now covered by it; their files are
+            # indexed already, so only the rest of root gets added.
+            self.roots = [known for known in self.roots if not is_inside(known, root)] + [root]
+        if scan:
+            start = time.perf_counter()
+            paths, _ = walk_media_folders([root])
+            with self.lock:
+                for path in sorted(paths - self.paths):
+                    self.paths.add(path)
+                    self.by_name.setdefault(os.path.basename(path).lower(), []).append(path)
+                self.by_umid = None
+                self.scan_seconds += time.perf_counter() - start
+
+    def scan(self):
+        start = time.perf_counter()
+        with self.lock:
+            roots = list(self.roots)
+        paths, by_name = walk_media_folders(roots)
+        with self.lock:
+            # Roots added during the walk were indexed by add_root.
+            added = [root for root in self.roots if root not in roots]
+            if added:
+                paths |= {path for path in self.paths if any(is_inside(path, root) for root in added)}
+                by_name = {}
+                for path in sorted(paths):
+                    by_name.setdefault(os.path.basename(path).lower(), []).append(path)
+            self.paths = paths
+            self.by_name = by_name
+            self.by_umid = None
+            self.scanned_at = time.monotonic()
+            self.scan_seconds += time.perf_counter() - start
+
+    def index_umids(self):
+        start = time.perf_counter()
+        umids = {}
+        for name, paths in self.by_name.items():
+            if not name.endswith(".mxf"):
+                continue
+            for path in paths:
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                    known = self.umids.get(path)
+                    umids[path] = known if known and known[0] == mtime \
+                        else (mtime, [key for uid in read_mxf_package_uids(path) for key in umid_keys(uid)])
+                except OSError:
+                    continue
+        self.umids = umids
+        self.by_umid = {}
+        for name, paths in self.by_name.items():
+            for path in paths:
+                for key in umids.get(path, (None, []))[1]:
+                    self.by_umid.setdefault(key, path)
+        self.scan_seconds += time.perf_counter() - start
+
+    # Returns the file for a path, or None. A file that exists is taken as
+    # is; otherwise an indexed file with the same name is used if there is
+    # exactly one, and the file whose UMID matches mob_id if not. Only one
+    # thread rescans at a time; the others don't wait for it.
+    def find(self, path, mob_id=None):
+        if os.path.isfile(path):
+            return path
+        with self.lock:
+            found = self.lookup(path, mob_id)
+            if found is not None or self.rescanning \
+                    or time.monotonic() - self.scanned_at < self.rescan_interval:
+                return found
+            self.rescanning = True
+        try:
+            self.scan()
+        finally:
+            with self.lock:
+                self.rescanning = False
+                found = self.lookup(path, mob_id)
+                if found is None:
+                    self.rescan_interval = min(self.rescan_interval * 2, MEDIA_RESCAN_MAX_INTERVAL)
+                else:
+                    self.rescan_interval = MEDIA_RESCAN_INTERVAL
+        return found
+
+    def lookup(self, path, mob_id=None):
+        path = os.path.normpath(os.path.abspath(path))
+        if path in self.paths:
+            return path
+        candidates = self.by_name.get(os.path.basename(path).lower(), [])
+        if len(candidates) == 1:
+            return candidates[0]
+        if mob_id is not None:
+            if self.by_umid is None:
+                self.index_umids()
+            key = mob_id_key(mob_id)
+            if key in self.by_umid:
+                return self.by_umid[key]
+        if candidates:
+            return candidates[0]
+        return None
 
 
-def resolve_media_path(source, aaf_directory):
+# Files under destination_folder (extracted essence) are ours, and never
+# swapped for a file of the same name found elsewhere.
+def resolve_media_path(source, aaf_directory, media_index=None, destination_folder=None):
     if source and os.path.isfile(source):
         return source
+    if destination_folder and source and is_inside(os.path.abspath(source), os.path.abspath(destination_folder)):
+        return source
+    if media_index is not None and source:
+        found = media_index.find(source)
+        if found:
+            return found
     local = os.path.join(aaf_directory, os.path.basename(source))
     if os.path.isfile(local):
         return local
@@ -458,27 +1420,36 @@ def resolve_media_path(source, aaf_directory):
 def format_reaper_fade(direction, item):
     fade_key = "fadein" if direction == "in" else "fadeout"
     type_key = "fadeintype" if direction == "in" else "fadeouttype"
-    length = item.get(fade_key, 0) or 0
-    shape = item.get(type_key, 0)
+    length = getattr(item, fade_key) or 0
+    shape = getattr(item, type_key) or 0
     reaper_shape = 2 if shape == 1 else 0
     tag = "FADEIN" if direction == "in" else "FADEOUT"
     return f"        {tag} 1 {length} {reaper_shape} 1 0 0 0\n"
 
 
-def build_envelope_block(tag, points, value_key="value"):
-    lines = [
-        f"    <{tag}",
-        f"      EGUID {new_eguid()}",
-        "      ACT 1 -1",
-        "      VIS 1 1 1",
-        "      LANEHEIGHT 0 0",
-        "      ARM 0",
-        "      DEFSHAPE 0 -1 -1",
-    ]
-    for point in sorted(points, key=lambda p: p["time"]):
-        lines.append(f"      PT {point['time']} {point[value_key]} 0")
-    lines.append("    >")
-    return "\n".join(lines) + "\n"
+def iter_envelope_block(tag, envelope):
+    yield (
+        f"    <{tag}\n"
+        f"      EGUID {new_eguid()}\n"
+        "      ACT 1 -1\n"
+        "      VIS 1 1 1\n"
+        "      LANEHEIGHT 0 0\n"
+        "      ARM 0\n"
+        "      DEFSHAPE 0 -1 -1\n"
+    )
+    envelope = envelope.sorted()
+    times, values = envelope.time_list(), envelope.value_list()
+    for start in range(0, len(times), ENVELOPE_WRITE_BATCH):
+        end = min(start + ENVELOPE_WRITE_BATCH, len(times))
+        fields = [None] * (2 * (end - start))
+        fields[0::2] = times[start:end]
+        fields[1::2] = values[start:end]
+        yield ("      PT {} {} 0\n" * (end - start)).format(*fields)
+    yield "    >\n"
+
+
+def build_envelope_block(tag, envelope):
+    return "".join(iter_envelope_block(tag, envelope))
 
 
 def detect_sample_rate(wav_path):
@@ -489,69 +1460,958 @@ def detect_sample_rate(wav_path):
         return None
 
 
-def convert_mxf_to_wav(mxf_path, wav_path):
-    audio_clip = AudioFileClip(mxf_path)
-    sample_rate = audio_clip.fps or 48000
-    audio_clip.write_audiofile(wav_path, fps=sample_rate, logger=None)
-    audio_clip.close()
+# Most MXFs exported by Resolve hold plain PCM, which is copied straight
+# into the WAV. Only compressed essence goes through MoviePy/FFmpeg.
+# start and end (seconds) limit the conversion to a region of the source.
+# With peaks, copied PCM gets its REAPER peak file in the same pass; for
+# decoded audio write_missing_peaks reads the WAV afterwards.
+def convert_mxf_to_wav(mxf_path, wav_path, start=None, end=None, peaks=False):
+    try:
+        sample_rate = mxf_pcm_to_wav(mxf_path, wav_path, start, end, peaks)
+        if sample_rate:
+            return sample_rate
+
+        if AudioFileClip is None:
+            raise RuntimeError("MoviePy is required to convert compressed audio in %s" % os.path.basename(mxf_path))
+        audio_clip = AudioFileClip(mxf_path)
+        try:
+            sample_rate = audio_clip.fps or 48000
+            clip = audio_clip
+            if start is not None:
+                clip = audio_clip.subclipped(start, min(end, audio_clip.duration))
+            clip.write_audiofile(wav_path, fps=sample_rate, logger=None)
+        finally:
+            audio_clip.close()
+    except Exception:
+        # Don't leave a half written WAV behind, or the next run
+        # would think the file was already converted.
+        if os.path.isfile(wav_path):
+            os.remove(wav_path)
+        raise
     return sample_rate
 
 
+def read_wav_format(wav_path):
+    try:
+        with wave.open(wav_path, "rb") as wav_file:
+            return wav_file.getframerate(), wav_file.getsampwidth()
+    except (wave.Error, EOFError, OSError):
+        return None
+
+
+# Splits the first length bytes of interleaved PCM into one byte string
+# per channel. With NumPy each channel is a strided view of the buffer,
+# copied once on the way out; without, extended slices do the same.
+def deinterleave(data, channels, width, length=None):
+    length = len(data) if length is None else length
+    if np is not None:
+        frames = np.frombuffer(data, np.uint8, count=length).reshape(-1, channels, width)
+        return [frames[:, channel].tobytes() for channel in range(channels)]
+    block_align = channels * width
+    outputs = []
+    for channel in range(channels):
+        output = bytearray(length // channels)
+        for byte in range(width):
+            output[byte::width] = data[channel * width + byte:length:block_align]
+        outputs.append(bytes(output))
+    return outputs
+
+
+# PCM bytes to float samples in [-1, 1), shaped (frames, channels).
+def pcm_to_float(frames, width, channels):
+    if width == 1:
+        samples = (np.frombuffer(frames, np.uint8) - 128.0) / 128
+    elif width == 3:
+        raw = np.frombuffer(frames, np.uint8).reshape(-1, 3).astype(np.int32)
+        # The top byte carries the sign.
+        raw[:, 2] = raw[:, 2].astype(np.int8)
+        samples = (raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)) / float(1 << 23)
+    else:
+        samples = np.frombuffer(frames, "<i%d" % width) / float(1 << (8 * width - 1))
+    return samples.reshape(-1, channels)
+
+
+# Float samples to PCM bytes, with TPDF dither if asked.
+def float_to_pcm(samples, width, dither=False):
+    scale = float(1 << (8 * width - 1))
+    values = samples.reshape(-1) * scale
+    if dither:
+        values += np.random.random_sample(values.shape) - np.random.random_sample(values.shape)
+    values = np.clip(np.rint(values), -scale, scale - 1)
+    if width == 1:
+        return (values + 128).astype(np.uint8).tobytes()
+    if width == 3:
+        return values.astype("<i4").view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return values.astype("<i%d" % width).tobytes()
+
+
+def iter_wav_samples(reader, block_frames=NORMALIZE_BLOCK_FRAMES):
+    channels = reader.getnchannels()
+    width = reader.getsampwidth()
+    while True:
+        frames = reader.readframes(block_frames)
+        last = not frames or reader.tell() >= reader.getnframes()
+        yield pcm_to_float(frames, width, channels), last
+        if last:
+            return
+
+
+# Rewrites a WAV at another sample rate and/or width (bytes per sample),
+# to destination, which may be the source itself. Resampling uses soxr
+# (very high quality, streamed in blocks) when it is installed, else
+# SciPy's polyphase resampler on the whole file. Output narrower than 24
+# bits is dithered. With peaks, the new WAV's peak file is written too.
+def normalize_wav(source, destination, rate, width, peaks=False):
+    if np is None:
+        raise VeaperError("Normalizing audio needs NumPy")
+    temp_path = destination + ".tmp"
+    try:
+        with wave.open(source, "rb") as reader, wave.open(temp_path, "wb") as writer:
+            channels = reader.getnchannels()
+            source_rate = reader.getframerate()
+            writer.setnchannels(channels)
+            writer.setsampwidth(width)
+            writer.setframerate(rate)
+            dither = width < 3 and (rate != source_rate or width < reader.getsampwidth())
+            builder = PeakBuilder(channels, width, rate) if peaks else None
+
+            blocks = iter_wav_samples(reader)
+            if rate != source_rate:
+                if soxr is not None:
+                    stream = soxr.ResampleStream(source_rate, rate, channels, dtype="float64", quality="VHQ")
+                    blocks = ((stream.resample_chunk(samples, last=last), last) for samples, last in blocks)
+                elif resample_poly is not None:
+                    samples = np.concatenate([samples for samples, _ in blocks])
+                    factor = math.gcd(rate, source_rate)
+                    samples = resample_poly(samples, rate // factor, source_rate // factor, axis=0,
+                                            window=("kaiser", 10.0))
+                    blocks = [(samples, True)]
+                else:
+                    raise VeaperError("Resampling needs the soxr or scipy package")
+
+            for samples, _ in blocks:
+                frames = float_to_pcm(samples, width, dither)
+                writer.writeframes(frames)
+                if builder is not None:
+                    builder.add(frames)
+        # Replaces rather than rewrites, as the destination may be a link
+        # to the original source.
+        os.replace(temp_path, destination)
+    except Exception:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+    if builder is not None:
+        builder.write(destination)
+    return rate
+
+
 def get_referenced_sources(data):
     sources = set()
     for track in get_audio_tracks(data):
-        for item in track.get("items", []):
-            source = item.get("source", "")
-            if source:
-                sources.add(source)
+        for item in track.items:
+            if item.source:
+                sources.add(item.source)
     return sources
 
 
-def convert_referenced_media(sources, aaf_directory, destination_folder):
-    sample_rates = []
+# Runs MXF conversions in a pool of worker processes. FFmpeg decoding is
+# CPU bound, so a process per core keeps big exports from idling the machine.
+# At most queue_size jobs are in flight at once, so the pool never holds
+# more pending work than it can chew on.
+#
+# One converter can be shared by several threads (e.g. one per AAF being
+# imported); queue_size then bounds the jobs of all of them together.
+class MediaConverter:
+
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.queue_size = max(self.workers, queue_size or self.workers * 2)
+        if self.workers == 1:
+            # Jobs run inline on the calling threads (see run), and one
+            # worker means one job at a time, whatever the queue size.
+            self.queue_size = 1
+        self.executor = None
+        # Worker processes report their PIDs here (see register_worker),
+        # so cancel() can end them.
+        self.worker_pids = None
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(self.queue_size)
+        self.cancelled = threading.Event()
+
+    def start(self):
+        with self.lock:
+            if self.executor is None and self.workers > 1:
+                self.new_executor()
+        return self
+
+    # Call with self.lock held.
+    def new_executor(self):
+        self.worker_pids = multiprocessing.SimpleQueue()
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=register_worker,
+                                                               initargs=(self.worker_pids,))
+        return self.executor
+
+    def shutdown(self, cancel=False):
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=cancel)
+
+    # Stops all conversions, from any thread. Queued jobs are dropped, the
+    # running ones killed, and every run() in progress raises VeaperCancelled.
+    # The converter can't be used afterwards.
+    def cancel(self):
+        self.cancelled.set()
+        with self.lock:
+            executor = self.executor
+            worker_pids = self.worker_pids
+            self.executor = None
+            self.worker_pids = None
+        if executor is not None:
+            # The executor has no way to stop a running job, so end the
+            # worker processes themselves.
+            executor.shutdown(wait=False, cancel_futures=True)
+            while not worker_pids.empty():
+                try:
+                    os.kill(worker_pids.get(), signal.SIGTERM)
+                except OSError:
+                    # Already gone.
+                    pass
 
-    for source in sources:
-        resolved = resolve_media_path(source, aaf_directory)
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(cancel=exc_type is not None)
+
+    def submit(self, job):
+        with self.lock:
+            if self.cancelled.is_set():
+                raise VeaperCancelled("Conversion cancelled")
+            if self.executor is None:
+                self.new_executor()
+            executor = self.executor
+            return executor.submit(job[1], *job[2]), executor
+
+    # Replaces a pool that lost a worker, unless another thread already did.
+    def restart(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    # jobs is a list of (key, function, args) tuples. Yields (key, result, error)
+    # as jobs finish; exactly one of result and error is None.
+    def run(self, jobs):
+        if self.workers == 1:
+            for key, function, args in jobs:
+                # Inline jobs hold a slot too, so threads sharing the
+                # converter still run only one at a time.
+                self.slots.acquire()
+                if self.cancelled.is_set():
+                    self.slots.release()
+                    raise VeaperCancelled("Conversion cancelled")
+                try:
+                    result = function(*args)
+                except Exception as e:
+                    self.failures[key] = str(e)
+                    result = None
+                    error = str(e)
+                else:
+                    error = None
+                finally:
+                    self.slots.release()
+                yield key, result, error
+            return
+
+        jobs = iter(jobs)
+        retries = []
+        pending = {}
+        exhausted = False
+        try:
+            while pending or retries or not exhausted:
+                while True:
+                    if retries:
+                        # Retries run on their own so a crash pins down its culprit.
+                        if not pending and self.slots.acquire():
+                            future, executor = self.submit(retries[-1])
+                            pending[future] = retries.pop() + (executor,)
+                        break
+                    if exhausted:
+                        break
+                    # Only block for a free slot when there is nothing of
+                    # our own to wait for, or threads could starve each other.
+                    if not self.slots.acquire(blocking=not pending):
+                        break
+                    try:
+                        key, function, args = next(jobs)
+                    except StopIteration:
+                        self.slots.release()
+                        exhausted = True
+                        break
+                    job = (key, function, args, 0)
+                    future, executor = self.submit(job)
+                    pending[future] = job + (executor,)
+
+                if not pending:
+                    continue
+                done, _ = concurrent.futures.wait(pending, timeout=0.5, return_when=concurrent.futures.FIRST_COMPLETED)
+                if self.cancelled.is_set():
+                    raise VeaperCancelled("Conversion cancelled")
+                broken = None
+                for future in done:
+                    key, function, args, attempts, executor = pending.pop(future)
+                    self.slots.release()
+                    try:
+                        yield key, future.result(), None
+                    except BrokenProcessPool:
+                        # A worker died (e.g. FFmpeg crashed hard on a broken file)
+                        # and took every job in the pool down with it. We can't
+                        # tell which one was the culprit, so each gets one more
+                        # go, alone in a fresh pool, before it is reported as failed.
+                        broken = executor
+                        if attempts == 0:
+                            retries.append((key, function, args, 1))
+                        else:
+                            self.failures[key] = "Worker process died"
+                            yield key, None, "Worker process died"
+                    except Exception as e:
+                        self.failures[key] = str(e)
+                        yield key, None, str(e)
+                if broken is not None:
+                    for future, (key, function, args, attempts, executor) in list(pending.items()):
+                        if executor is broken:
+                            del pending[future]
+                            self.slots.release()
+                            retries.append((key, function, args, 1))
+                    self.restart(broken)
+        finally:
+            # The caller stopped early (or we failed): give our slots back.
+            for future in pending:
+                future.cancel()
+                self.slots.release()
+
+
+# Runs in every new MediaConverter worker process.
+def register_worker(worker_pids):
+    worker_pids.put(os.getpid())
+
+
+# Hashes the size and three blocks (start, middle, end) of a file. Much
+# cheaper than hashing gigabytes of audio, and a re-export practically
+# always changes at least one of them.
+def fingerprint_file(path, size):
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    offsets = {0, max(0, size // 2 - FINGERPRINT_BLOCK_SIZE // 2), max(0, size - FINGERPRINT_BLOCK_SIZE)}
+    with open(path, "rb") as f:
+        for offset in sorted(offsets):
+            f.seek(offset)
+            digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def load_json_file(path):
+    try:
+        with open(path, "r") as json_file:
+            return json.load(json_file)
+    except Exception:
+        return {}
+
+
+# A new, uniquely named file next to path, for writing path's new
+# contents to before renaming it into place. Several threads or processes
+# may be writing the same path at once.
+def make_temp_file(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    return tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory)
+
+
+def write_json_file(path, data):
+    # Write to a temporary file first, so a crash never leaves half a file.
+    fd, temp_path = make_temp_file(path)
+    try:
+        with os.fdopen(fd, "w") as json_file:
+            json.dump(data, json_file, indent=4)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+# Puts a link to (or copy of) source at destination, unless another thread
+# or process got a file there first. A copy is made under a temporary name,
+# so destination is never seen half written.
+def publish_file(source, destination):
+    try:
+        os.link(source, destination)
+        return
+    except FileExistsError:
+        return
+    except OSError:
+        pass
+    fd, temp_path = make_temp_file(destination)
+    os.close(fd)
+    try:
+        shutil.copy2(source, temp_path)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# Serialises read-modify-write updates of a file shared by concurrent
+# imports: a lock for the threads of this process, and an exclusive flock
+# on lock_path for other processes (where fcntl exists; elsewhere only
+# threads are serialised).
+SHARED_FILE_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def shared_file_lock(lock_path):
+    with SHARED_FILE_LOCK:
+        with open(lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def reflink_file(source, destination):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Copy-on-write clones are not supported here")
+    try:
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    except OSError:
+        if os.path.lexists(destination):
+            os.remove(destination)
+        raise
+    shutil.copystat(source, destination)
+
+
+STAGING_METHODS = {
+    "reflink": reflink_file,
+    "hardlink": os.link,
+    "symlink": lambda source, destination: os.symlink(os.path.abspath(source), destination),
+    "copy": shutil.copy2,
+}
+
+
+# Returns the staging methods for a policy name.
+def staging_policy(staging):
+    if staging not in STAGING_POLICIES:
+        raise VeaperError("Unknown staging policy %r (choose from: %s)"
+                          % (staging, ", ".join(sorted(STAGING_POLICIES))))
+    return STAGING_POLICIES[staging]
+
+
+# Puts source at destination with the first of methods (see
+# STAGING_POLICIES) that works there, and returns its name.
+def stage_file(source, destination, methods):
+    for method in methods[:-1]:
+        try:
+            STAGING_METHODS[method](source, destination)
+            return method
+        except (OSError, NotImplementedError):
+            pass
+    STAGING_METHODS[methods[-1]](source, destination)
+    return methods[-1]
+
+
+# Remembers what every source was converted to, keyed by the source's size,
+# mtime and content fingerprint, so unchanged sources are never converted
+# twice and re-exported ones always are. Sources that share a file name get
+# distinct WAV names.
+#
+# With a shared_dir, converted WAVs are also kept there under their
+# fingerprint and reused by other projects. The least recently used files
+# are evicted once the directory grows past shared_max_size bytes.
+#
+# With trust_mtime, a source whose size and mtime match the last run keeps
+# its fingerprint without the file being read again, so only new or
+# touched media costs anything.
+class ConversionCache:
+
+    def __init__(self, destination_folder, shared_dir=None, shared_max_size=SHARED_CACHE_MAX_SIZE, trust_mtime=False):
+        self.destination_folder = destination_folder
+        self.manifest_path = os.path.join(destination_folder, CACHE_MANIFEST_NAME)
+        manifest = load_json_file(self.manifest_path)
+        self.entries = manifest.get("files", {})
+        self.sources = manifest.get("sources", {})
+        self.trust_mtime = trust_mtime
+        self.claimed = {entry["wav"]: path for path, entry in self.entries.items()}
+        self.wav_names = {}
+        self.hits = 0
+
+        self.shared_dir = shared_dir
+        self.shared_max_size = shared_max_size
+        self.shared_index = {}
+        self.shared_touched = set()
+        self.shared_evicted = set()
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+            self.shared_index = load_json_file(os.path.join(shared_dir, SHARED_CACHE_INDEX_NAME))
+
+    def stat_source(self, path):
+        stat = os.stat(path)
+        known = self.sources.get(os.path.abspath(path))
+        if self.trust_mtime and known and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns:
+            fingerprint = known["fingerprint"]
+        else:
+            fingerprint = fingerprint_file(path, stat.st_size)
+        info = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "fingerprint": fingerprint,
+        }
+        self.sources[os.path.abspath(path)] = dict(info)
+        return info
+
+    # Picks the WAV file name for a source key (see media_key) and reserves
+    # it for this run. With keep, the name is taken even if another source
+    # had it, which is what files already in the destination need.
+    def claim(self, key, info, name, keep=False):
+        if key in self.wav_names:
+            return self.wav_names[key]
+        base = os.path.splitext(name)[0]
+        candidate = name
+        counter = 1
+        while not keep and self.claimed.get(candidate, key) != key:
+            suffix = info["fingerprint"][:8] if counter == 1 else "%s_%d" % (info["fingerprint"][:8], counter)
+            candidate = "%s_%s.wav" % (base, suffix)
+            counter += 1
+        self.claimed[candidate] = key
+        self.wav_names[key] = candidate
+        return candidate
+
+    # Returns the manifest entry if an up to date WAV for the source is in
+    # place (fetching it from the shared cache if needed), None otherwise.
+    def lookup(self, key, info, use_shared=True):
+        wav_path = os.path.join(self.destination_folder, self.wav_names[key])
+        entry = self.entries.get(key)
+        if entry and entry["wav"] == self.wav_names[key] and os.path.isfile(wav_path) \
+                and all(entry.get(k) == info[k] for k in ("size", "mtime", "fingerprint")):
+            self.hits += 1
+            return entry
+
+        # Anything at the WAV path is stale. Remove rather than overwrite it,
+        # as it may be a hard link into the shared cache.
+        if os.path.lexists(wav_path):
+            os.remove(wav_path)
+
+        if use_shared and self.shared_dir and info["fingerprint"] in self.shared_index:
+            shared_path = os.path.join(self.shared_dir, info["fingerprint"] + ".wav")
+            if os.path.isfile(shared_path):
+                link_or_copy(shared_path, wav_path)
+                rate = self.shared_index[info["fingerprint"]].get("rate")
+                self.shared_index[info["fingerprint"]]["last_used"] = time.time()
+                self.shared_touched.add(info["fingerprint"])
+                self.store(key, info, rate, share=False)
+                self.hits += 1
+                return self.entries[key]
+        return None
+
+    def store(self, key, info, rate, share=True):
+        wav_name = self.wav_names[key]
+        self.entries[key] = dict(info, wav=wav_name, rate=rate)
+
+        if share and self.shared_dir:
+            fingerprint = info["fingerprint"]
+            shared_path = os.path.join(self.shared_dir, fingerprint + ".wav")
+            try:
+                if not os.path.isfile(shared_path):
+                    publish_file(os.path.join(self.destination_folder, wav_name), shared_path)
+                self.shared_index[fingerprint] = {
+                    "size": os.path.getsize(shared_path),
+                    "rate": rate,
+                    "last_used": time.time(),
+                }
+                self.shared_touched.add(fingerprint)
+            except OSError as e:
+                log("Could not add %s to the shared cache: %s" % (wav_name, e), WARNING)
+
+    def evict(self, index):
+        total = sum(entry.get("size", 0) for entry in index.values())
+        for fingerprint in sorted(index, key=lambda f: index[f].get("last_used", 0)):
+            if total <= self.shared_max_size:
+                break
+            total -= index[fingerprint].get("size", 0)
+            del index[fingerprint]
+            self.shared_evicted.add(fingerprint)
+            try:
+                os.remove(os.path.join(self.shared_dir, fingerprint + ".wav"))
+            except OSError:
+                pass
+
+    def save(self):
+        write_json_file(self.manifest_path, {"version": 1, "files": self.entries, "sources": self.sources})
+
+        if self.shared_dir:
+            # Other projects may have used the shared cache meanwhile,
+            # so merge our changes into the index as it is on disk now.
+            index_path = os.path.join(self.shared_dir, SHARED_CACHE_INDEX_NAME)
+            with shared_file_lock(os.path.join(self.shared_dir, SHARED_CACHE_LOCK_NAME)):
+                index = load_json_file(index_path)
+                for fingerprint in self.shared_touched:
+                    index[fingerprint] = self.shared_index[fingerprint]
+                for fingerprint in self.shared_evicted:
+                    index.pop(fingerprint, None)
+                if self.shared_max_size:
+                    self.evict(index)
+                write_json_file(index_path, index)
+            self.shared_index = index
+            self.shared_touched = set()
+
+
+# Cache and file name key for a source, or for one region of it.
+def media_key(path, region=None):
+    key = os.path.abspath(path)
+    if region is not None:
+        key += "@%.6f-%.6f" % region
+    return key
+
+
+# Source ranges used by the timeline, per source: [(start, end), ...] in
+# seconds, widened by handles on both sides and merged where they touch.
+def collect_source_ranges(data, handles=CONSOLIDATE_HANDLES):
+    ranges = {}
+    for track in get_audio_tracks(data):
+        for item in track.items:
+            source = item.source
+            if not source:
+                continue
+            start = item.offset or 0
+            end = start + item.duration * (item.playbackrate or 1)
+            ranges.setdefault(source, []).append((max(0.0, start - handles), end + handles))
+
+    for source, source_ranges in ranges.items():
+        merged = []
+        for start, end in sorted(source_ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        ranges[source] = merged
+    return ranges
+
+
+def find_source_range(ranges, offset):
+    for region in ranges:
+        if region[0] <= offset + 1e-6 and offset <= region[1]:
+            return region
+    return None
+
+
+def region_wav_name(path, region):
+    return "%s_%d-%d.wav" % (os.path.splitext(os.path.basename(path))[0], region[0] * 1000, region[1] * 1000)
+
+
+def copy_wav_region(source, destination, start, end, chunk_frames=1024 * 1024, peaks=False):
+    with wave.open(source, "rb") as reader, wave.open(destination, "wb") as writer:
+        rate = reader.getframerate()
+        writer.setnchannels(reader.getnchannels())
+        writer.setsampwidth(reader.getsampwidth())
+        writer.setframerate(rate)
+        builder = PeakBuilder(reader.getnchannels(), reader.getsampwidth(), rate) if peaks else None
+        first = min(round(start * rate), reader.getnframes())
+        remaining = min(round(end * rate), reader.getnframes()) - first
+        reader.setpos(first)
+        while remaining > 0:
+            frames = reader.readframes(min(chunk_frames, remaining))
+            if not frames:
+                break
+            writer.writeframesraw(frames)
+            if builder is not None:
+                builder.add(frames)
+            remaining -= min(chunk_frames, remaining)
+    if builder is not None:
+        builder.write(destination)
+    return rate
+
+
+# Brings every WAV of the project (outputs: {key: source info}, keys of
+# cache.wav_names) to rate and width (bytes per sample), converting those
+# that differ on the converter. None picks the highest rate and widest
+# width among them. Files in the project folder are rewritten in place;
+# referenced sources (see STAGING_POLICIES) get a converted copy there
+# instead. Returns the rate, or None if no WAV could be read.
+def normalize_media(outputs, destination_folder, cache, converter, rate=None, width=None, failures=None,
+                    progress=None, stats=None, peaks=False):
+    stats = stats or ImportStats()
+    formats = {}
+    for key in outputs:
+        wav_format = read_wav_format(os.path.join(destination_folder, cache.wav_names[key]))
+        if wav_format is None:
+            log("Can't normalize %s, it isn't a PCM WAV file." % os.path.basename(cache.wav_names[key]), WARNING)
+        else:
+            formats[key] = wav_format
+    if not formats:
+        return None
+    rate = rate or max(wav_rate for wav_rate, _ in formats.values())
+    width = width or max(wav_width for _, wav_width in formats.values())
+
+    jobs = []
+    sizes = {}
+    referenced = {}
+    for key, wav_format in sorted(formats.items()):
+        if wav_format == (rate, width):
+            continue
+        source = os.path.join(destination_folder, cache.wav_names[key])
+        if os.path.isabs(cache.wav_names[key]):
+            # Referenced where it is; don't touch the original.
+            referenced[key] = cache.wav_names.pop(key)
+            cache.claim(key, outputs[key], os.path.basename(source))
+        destination = os.path.join(destination_folder, cache.wav_names[key])
+        jobs.append((key, timed_call, (normalize_wav, source, destination, rate, width, peaks)))
+        sizes[key] = os.path.getsize(source)
+
+    if not jobs:
+        return rate
+    report_progress(progress, "convert", "Normalizing %d files..." % len(jobs), 0, len(jobs))
+    for done, (key, result, error) in enumerate(converter.run(jobs), 1):
+        name = os.path.basename(cache.wav_names[key])
+        report_progress(progress, "convert", "Normalized %s" % name, done, len(jobs))
+        if error is not None:
+            log("Failed to normalize %s: %s" % (name, error), ERROR)
+            if key in referenced:
+                cache.wav_names[key] = referenced[key]
+            if failures is not None:
+                failures[name] = error
+            continue
+        source_rate, source_width = formats[key]
+        log("Normalized %s: %d Hz %d bit to %d Hz %d bit" % (name, source_rate, source_width * 8, rate, width * 8))
+        _, seconds = result
+        stats.add_file(name, "normalized", seconds, sizes[key],
+                       os.path.getsize(os.path.join(destination_folder, name)),
+                       from_rate=source_rate, from_bits=source_width * 8, to_rate=rate, to_bits=width * 8)
+        if key in cache.entries:
+            cache.store(key, outputs[key], rate, share=False)
+    return rate
+
+
+# Writes REAPER peak files for the WAVs of the project (outputs, as for
+# normalize_media) that have no up to date one: those staged or taken from
+# the cache, or decoded by FFmpeg. Referenced sources are left to REAPER,
+# so nothing is written to their folders. A peak file that can't be
+# written is only a warning; REAPER builds it when the project opens.
+def write_missing_peaks(outputs, destination_folder, cache, converter, progress=None, stats=None):
+    stats = stats or ImportStats()
+    jobs = []
+    for key in sorted(outputs):
+        name = cache.wav_names.get(key)
+        if name is None or os.path.isabs(name):
+            continue
+        wav_path = os.path.join(destination_folder, name)
+        if os.path.isfile(wav_path) and not peaks_up_to_date(wav_path):
+            jobs.append((key, timed_call, (write_wav_peaks, wav_path)))
+
+    if not jobs:
+        return
+    report_progress(progress, "convert", "Building peaks of %d files..." % len(jobs), 0, len(jobs))
+    for done, (key, result, error) in enumerate(converter.run(jobs), 1):
+        name = os.path.basename(cache.wav_names[key])
+        report_progress(progress, "convert", "Built peaks of %s" % name, done, len(jobs))
+        if error is not None:
+            log("Could not write the peak file of %s: %s" % (name, error), WARNING)
+            continue
+        stats.count("peak_files_read")
+        stats.count("peak_seconds", result[1])
+
+
+# With ranges (see collect_source_ranges), only the used regions of each
+# source are converted, each to its own WAV, instead of the whole file.
+# Files that fail to convert are logged and, if failures is given,
+# added to it as {file name: error}.
+#
+# Returns the project sample rate: sample_rate, or the highest rate among
+# the sources. With normalize, sources at another rate or sample width
+# (bit_depth, default the widest among them) are converted to it.
+#
+# With peaks, every WAV in the project folder gets a REAPER peak file,
+# computed while it is written where possible (see write_missing_peaks).
+def convert_referenced_media(sources, aaf_directory, destination_folder, converter=None, cache=None, ranges=None,
+                             failures=None, progress=None, media_index=None, stats=None, staging="link",
+                             normalize=False, sample_rate=None, bit_depth=None, peaks=False):
+    staging_methods = staging_policy(staging)
+    if cache is None:
+        cache = ConversionCache(destination_folder)
+    stats = stats or ImportStats()
+    sample_rates = []
+    outputs = {}
+    sizes = {}
+    jobs = []
+    pending = {}
+
+    # Sorted, so clashing file names get the same WAV names on every run.
+    for source in sorted(sources):
+        resolved = resolve_media_path(source, aaf_directory, media_index, destination_folder)
         if not resolved or not os.path.isfile(resolved):
-            print("Missing media file: %s" % source, WARNING)
+            log("Missing media file: %s" % source, WARNING)
             continue
 
         ext = os.path.splitext(resolved)[1].lower()
-        if ext == ".mxf":
-            wav_name = os.path.splitext(os.path.basename(resolved))[0] + ".wav"
-            wav_path = os.path.join(destination_folder, wav_name)
-            if not os.path.isfile(wav_path):
-                print("Converting %s..." % os.path.basename(resolved))
-                rate = convert_mxf_to_wav(resolved, wav_path)
-            else:
-                rate = detect_sample_rate(wav_path)
+        if ext not in [".mxf", ".wav"]:
+            continue
+
+        info = cache.stat_source(resolved)
+        if ext == ".wav" and os.path.dirname(os.path.abspath(resolved)) == os.path.abspath(destination_folder):
+            # Already in place, e.g. extracted embedded essence.
+            cache.claim(media_key(resolved), info, os.path.basename(resolved), keep=True)
+            outputs[media_key(resolved)] = info
+            rate = detect_sample_rate(resolved)
             if rate:
                 sample_rates.append(rate)
-        elif ext == ".wav":
-            dest_path = os.path.join(destination_folder, os.path.basename(resolved))
-            if os.path.abspath(resolved) != os.path.abspath(dest_path) and not os.path.isfile(dest_path):
-                shutil.copy2(resolved, dest_path)
-            rate = detect_sample_rate(dest_path if os.path.isfile(dest_path) else resolved)
+            continue
+
+        if ranges is not None and source in ranges:
+            regions = ranges[source]
+        else:
+            regions = [None]
+
+        if ext == ".wav" and staging == "reference" and regions == [None]:
+            # Left in place. The WAV name is its absolute path, which is
+            # what the project will point at; nothing goes in the manifest.
+            cache.wav_names[media_key(resolved)] = os.path.abspath(resolved)
+            outputs[media_key(resolved)] = info
+            rate = detect_sample_rate(resolved)
+            stats.add_file(os.path.basename(resolved), "referenced", 0.0, info["size"], 0)
+            if rate:
+                sample_rates.append(rate)
+            continue
+
+        for region in regions:
+            key = media_key(resolved, region)
+            if region is None:
+                region_info = info
+                wav_name = os.path.splitext(os.path.basename(resolved))[0] + ".wav"
+            else:
+                # Regions are distinct files, in the shared cache too.
+                region_info = dict(info, fingerprint="%s-%d-%d" % (info["fingerprint"], region[0] * 1000, region[1] * 1000))
+                wav_name = region_wav_name(resolved, region)
+            wav_path = os.path.join(destination_folder, cache.claim(key, region_info, wav_name))
+
+            entry = cache.lookup(key, region_info, use_shared=ext == ".mxf")
+            if entry is not None:
+                rate = entry.get("rate")
+                outputs[key] = region_info
+            elif ext == ".mxf":
+                jobs.append((key, timed_call, (convert_mxf_to_wav, resolved, wav_path) + (region or (None, None))
+                             + (peaks,)))
+                pending[key] = region_info
+                sizes[key] = info["size"]
+                continue
+            else:
+                start = time.perf_counter()
+                if region is None:
+                    method = stage_file(resolved, wav_path, staging_methods)
+                    rate = detect_sample_rate(wav_path)
+                else:
+                    method = "copy"
+                    rate = copy_wav_region(resolved, wav_path, *region, peaks=peaks)
+                if method == "copy":
+                    stats.add_file(os.path.basename(wav_path), "copied", time.perf_counter() - start, info["size"],
+                                   os.path.getsize(wav_path))
+                else:
+                    # Nothing was written.
+                    stats.add_file(os.path.basename(wav_path), "staged", time.perf_counter() - start, info["size"], 0)
+                    stats.count("staged_" + method)
+                cache.store(key, region_info, rate, share=False)
+            outputs[key] = region_info
             if rate:
                 sample_rates.append(rate)
 
+    if cache.hits:
+        log("Reused %d previously converted files." % cache.hits)
+    stats.count("cache_hits", cache.hits)
+
+    own_converter = converter is None and bool(jobs or normalize or peaks)
+    if own_converter:
+        converter = MediaConverter()
+    try:
+        if jobs:
+            bytes_total = sum(sizes.values())
+            bytes_done = 0
+            report_progress(progress, "convert", "Converting %d files..." % len(jobs), 0, len(jobs), 0, bytes_total)
+            for done, (key, result, error) in enumerate(converter.run(jobs), 1):
+                name = os.path.basename(cache.wav_names[key])
+                bytes_done += sizes[key]
+                report_progress(progress, "convert", "Converted %s" % name, done, len(jobs), bytes_done, bytes_total)
+                if error is not None:
+                    log("Failed to convert %s: %s" % (name, error), ERROR)
+                    if failures is not None:
+                        failures[name] = error
+                    continue
+                rate, seconds = result
+                log("Converted %s" % name)
+                stats.add_file(name, "converted", seconds, sizes[key],
+                               os.path.getsize(os.path.join(destination_folder, cache.wav_names[key])))
+                cache.store(key, pending[key], rate)
+                outputs[key] = pending[key]
+                if rate:
+                    sample_rates.append(rate)
+
+        if normalize:
+            rate = normalize_media(outputs, destination_folder, cache, converter, sample_rate,
+                                   bit_depth // 8 if bit_depth else None, failures, progress, stats, peaks)
+        if peaks:
+            write_missing_peaks(outputs, destination_folder, cache, converter, progress, stats)
+        if normalize and rate:
+            return rate
+    finally:
+        if own_converter:
+            converter.shutdown()
+        cache.save()
+
+    if sample_rate:
+        return sample_rate
     if sample_rates:
         return max(set(sample_rates))
     return 48000
 
 
-def rewrite_sources_for_reaper(data, aaf_directory):
+# Points items at the converted WAVs. With ranges, items are moved onto
+# the region file holding them and their offsets made relative to it.
+def rewrite_sources_for_reaper(data, aaf_directory, cache=None, ranges=None, media_index=None,
+                               destination_folder=None):
     for track in get_audio_tracks(data):
-        for item in track.get("items", []):
-            source = item.get("source", "")
+        for item in track.items:
+            source = item.source
             if not source:
                 continue
-            resolved = resolve_media_path(source, aaf_directory)
+            resolved = resolve_media_path(source, aaf_directory, media_index, destination_folder)
+
+            if cache is not None and ranges is not None and source in ranges:
+                offset = item.offset or 0
+                region = find_source_range(ranges[source], offset)
+                key = media_key(resolved, region)
+                if region is not None and key in cache.wav_names:
+                    item.source = cache.wav_names[key]
+                    item.offset = max(0.0, offset - region[0])
+                    continue
+
+            if cache is not None and media_key(resolved) in cache.wav_names:
+                item.source = cache.wav_names[media_key(resolved)]
+                continue
             basename = os.path.basename(resolved or source)
             name, ext = os.path.splitext(basename)
             if ext.lower() == ".mxf":
                 basename = name + ".wav"
-            item["source"] = basename
+            item.source = basename
 
 
 def build_reaper_project_header(sample_rate):
@@ -651,11 +2511,18 @@ def build_reaper_project_header(sample_rate):
 '''
 
 
-def build_reaper_track(track):
-    track_name = track.get("name", "Track").replace(" ", "\u00A0")
-    track_pan = track.get("panning", 0)
+# The project is generated piece by piece (a track header, an envelope
+# point, an item...) so it can be streamed to disk without ever holding
+# the whole thing in memory.
+def reaper_track_name(name):
+    return (name if name is not None else "Track").replace(" ", "\u00A0")
+
+
+def iter_reaper_track(track):
+    track_name = reaper_track_name(track.name)
+    track_pan = track.panning or 0
     lines = [
-        "   <TRACK",
+        "   <TRACK" if track.track_id is None else f"   <TRACK {track.track_id}",
         f"    NAME {track_name}",
         "    PEAKCOL 0",
         "    BEAT -1",
@@ -678,27 +2545,30 @@ def build_reaper_track(track):
         "    MIDIOUT -1",
         "    MAINSEND 1 0",
     ]
+    if track.track_id is not None:
+        lines.append(f"    TRACKID {track.track_id}")
+    yield "\n".join(lines) + "\n"
 
-    if track.get("volume_envelope"):
-        lines.append(build_envelope_block("VOLENV", track["volume_envelope"]).rstrip())
-    if track.get("panning_envelope"):
-        lines.append(build_envelope_block("PANENV", track["panning_envelope"]).rstrip())
+    if track.volume_envelope:
+        yield from iter_envelope_block("VOLENV", track.volume_envelope)
+    if track.panning_envelope:
+        yield from iter_envelope_block("PANENV", track.panning_envelope)
 
-    for item in track.get("items", []):
-        source = item.get("source", "")
+    for item in track.items:
+        source = item.source
         if not source:
             continue
 
-        volume = item.get("volume", 1)
-        playback_rate = item.get("playbackrate", 1)
-        source_offset = item.get("offset", 0) or 0
+        volume = item.volume if item.volume is not None else 1
+        playback_rate = item.playbackrate if item.playbackrate is not None else 1
+        source_offset = item.offset or 0
         file_name = os.path.basename(source)
 
-        lines.extend([
+        yield "\n".join([
             "    <ITEM",
-            f"     POSITION {item['position']}",
+            f"     POSITION {item.position}",
             "     SNAPOFFS 0",
-            f"     LENGTH {item['duration']}",
+            f"     LENGTH {item.duration}",
             "     LOOP 0",
             "     ALLTAKES 0",
             format_reaper_fade("in", item).rstrip(),
@@ -710,33 +2580,251 @@ def build_reaper_track(track):
             f"     VOLPAN {volume} 0 1 -1",
             f"     SOFFS {source_offset}",
             f"     PLAYRATE {playback_rate} 1 0 -1 0 0.0025",
-            "     CHANMODE 0",
+            f"     CHANMODE {channel_mode(item)}",
             "     <SOURCE WAVE",
             f'      FILE "{source}"',
             "     >",
             "    >",
-        ])
+        ]) + "\n"
 
-    lines.append("   >")
-    return "\n".join(lines) + "\n"
+    yield "   >\n"
 
 
-def build_reaper_project(data, sample_rate):
-    project = build_reaper_project_header(sample_rate)
+# Reaper's item channel modes: 0 plays the source as it is, 3 and up play
+# its first, second... channel alone.
+def channel_mode(item):
+    return item.channel + 2 if item.channel else 0
+
+
+def build_reaper_track(track):
+    return "".join(iter_reaper_track(track))
+
+
+def iter_reaper_project(data, sample_rate):
+    yield build_reaper_project_header(sample_rate)
     for track in get_audio_tracks(data):
-        project += build_reaper_track(track)
-    project += "  >\n>\n"
-    return project
+        yield from iter_reaper_track(track)
+    yield "  >\n>\n"
 
 
-def parse_aaf(aaf_interface, filename, target):
-    if not aaf_interface.open(filename):
-        return None
+def build_reaper_project(data, sample_rate):
+    return "".join(iter_reaper_project(data, sample_rate))
 
-    print("Getting data from %s..." % filename)
+
+# Streams the project into a temporary file next to rpp_path and renames it
+# into place once complete, so a failed export never leaves a truncated
+# project behind (or clobbers the previous one).
+def write_reaper_project(data, sample_rate, rpp_path, buffer_size=1024 * 1024):
+    temp_path = rpp_path + ".tmp"
+    try:
+        with open(temp_path, "w", buffering=buffer_size) as file:
+            file.writelines(iter_reaper_project(data, sample_rate))
+        os.replace(temp_path, rpp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return rpp_path
+
+
+# Incremental exports. Tracks of two runs are matched by their name in the
+# AAF (in order, for repeated names) and items by source, source offset,
+# length and rate; an item found again at another position has moved.
+def track_keys(tracks):
+    counts = {}
+    keys = []
+    for track in tracks:
+        name = reaper_track_name(track.name)
+        keys.append((name, counts.get(name, 0)))
+        counts[name] = counts.get(name, 0) + 1
+    return keys
+
+
+# Gives every audio track of the composition its GUID in the Reaper
+# project: the one of the same track in the previous export's composition,
+# or a new one.
+def assign_track_ids(data, previous=None):
+    known = {}
+    if previous is not None:
+        old_tracks = get_audio_tracks(previous)
+        known = {key: track.track_id for key, track in zip(track_keys(old_tracks), old_tracks) if track.track_id}
+    tracks = get_audio_tracks(data)
+    for key, track in zip(track_keys(tracks), tracks):
+        track.track_id = known.get(key) or new_eguid()
+
+
+def diff_items(old_items, new_items):
+    def identity(item):
+        return item.source, item.offset, item.duration, item.playbackrate
+
+    remaining = {}
+    for item in old_items:
+        remaining.setdefault(identity(item), []).append(item.position)
+    unmatched = []
+    for item in new_items:
+        positions = remaining.get(identity(item))
+        if positions and item.position in positions:
+            positions.remove(item.position)
+        else:
+            unmatched.append(item)
+
+    added = moved = 0
+    for item in unmatched:
+        positions = remaining.get(identity(item))
+        if positions:
+            positions.remove(min(positions, key=lambda position: abs(position - item.position)))
+            moved += 1
+        else:
+            added += 1
+    removed = sum(len(positions) for positions in remaining.values())
+    return added, removed, moved
+
+
+# Compares the audio tracks of the previous run's composition with the new
+# one. Returns {track key: {"status", "added", "removed", "moved",
+# "track_id"}}, where status is "added", "removed", "changed" or
+# "unchanged" and track_id is the track's GUID (see assign_track_ids),
+# None for tracks of exports made before they had one. A track can be
+# changed without any item being added, removed or moved, e.g. when only
+# its fades or automation differ.
+def diff_compositions(old, new):
+    old_tracks = get_audio_tracks(old)
+    old_tracks = dict(zip(track_keys(old_tracks), old_tracks))
+    new_tracks = get_audio_tracks(new)
+    changes = {}
+    for key, track in zip(track_keys(new_tracks), new_tracks):
+        previous = old_tracks.get(key)
+        if previous is None:
+            changes[key] = {"status": "added", "added": len(track.items), "removed": 0, "moved": 0,
+                            "track_id": track.track_id}
+            continue
+        added, removed, moved = diff_items(previous.items, track.items)
+        # The GUID isn't content, and exports before there were GUIDs lack it.
+        old_json = previous.to_json()
+        new_json = track.to_json()
+        old_json.pop("track_id", None)
+        new_json.pop("track_id", None)
+        changed = old_json != new_json
+        changes[key] = {"status": "changed" if changed else "unchanged",
+                        "added": added, "removed": removed, "moved": moved, "track_id": track.track_id}
+    for key, track in old_tracks.items():
+        if key not in changes:
+            changes[key] = {"status": "removed", "added": 0, "removed": len(track.items), "moved": 0,
+                            "track_id": track.track_id}
+    return changes
+
+
+def log_changes(changes):
+    changed = [(key, change) for key, change in changes.items() if change["status"] != "unchanged"]
+    if not changed:
+        log("No changes since the last export.")
+        return
+    for (name, _), change in changed:
+        log("Track %s %s: %d items added, %d removed, %d moved."
+            % (name.replace("\u00A0", " "), change["status"], change["added"], change["removed"], change["moved"]))
+
+
+# Splits an .rpp into [(track GUID, text)] where text is either one whole
+# <TRACK block (GUID from its header or TRACKID line, "" if it has none) or
+# the text between track blocks (GUID None).
+def split_reaper_tracks(text):
+    segments = []
+    current = []
+    track_id = None
+    depth = 0
+    for line in text.splitlines(True):
+        stripped = line.strip()
+        if depth == 0 and stripped.startswith("<TRACK"):
+            if current:
+                segments.append((None, "".join(current)))
+            current = []
+            track_id = stripped[6:].strip().upper()
+        current.append(line)
+        if track_id is None:
+            continue
+        if stripped.startswith("<"):
+            depth += 1
+        elif stripped == ">":
+            depth -= 1
+        elif depth == 1 and stripped.startswith("TRACKID "):
+            track_id = stripped[8:].strip().upper()
+        if depth == 0:
+            segments.append((track_id, "".join(current)))
+            current = []
+            track_id = None
+    if current:
+        segments.append((None, "".join(current)))
+    return segments
+
+
+# Writes only the changed and added tracks of data into the existing
+# project at rpp_path and drops removed ones, finding them by the GUIDs
+# they were written with (see assign_track_ids). Everything else,
+# including the project settings and tracks made in Reaper, is kept as it
+# is; a track whose GUID isn't one of ours is never touched. Returns False
+# (having written nothing) if none of the project's tracks has a GUID we
+# know, e.g. a project exported before tracks had them.
+def update_reaper_project(data, changes, rpp_path):
+    with open(rpp_path, "r") as file:
+        segments = split_reaper_tracks(file.read())
+    statuses = {change["track_id"].upper(): change["status"] for change in changes.values() if change["track_id"]}
+    if not any(track_id in statuses for track_id, _ in segments):
+        return False
+    last_track = max(i for i, (track_id, _) in enumerate(segments) if track_id is not None)
+
+    new_tracks = {track.track_id.upper(): track for track in get_audio_tracks(data)}
+    # Tracks missing from the project go after the track before them in the
+    # AAF, or at the end if none is before them.
+    present = {track_id for track_id, _ in segments if track_id in new_tracks}
+    inserted = {}
+    previous = None
+    for track_id, track in new_tracks.items():
+        if track_id in present:
+            previous = track_id
+        else:
+            inserted.setdefault(previous, []).append(track)
+
+    def iter_segments():
+        for i, (track_id, text) in enumerate(segments):
+            status = statuses.get(track_id)
+            if status == "changed":
+                yield from iter_reaper_track(new_tracks[track_id])
+            elif status != "removed":
+                # Untouched, or made in Reaper: keep it as it is.
+                yield text
+            if track_id in present:
+                for track in inserted.get(track_id, []):
+                    yield from iter_reaper_track(track)
+            if i == last_track:
+                for track in inserted.get(None, []):
+                    yield from iter_reaper_track(track)
+
+    temp_path = rpp_path + ".tmp"
+    try:
+        with open(temp_path, "w") as file:
+            file.writelines(iter_segments())
+        os.replace(temp_path, rpp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return True
+
+
+# Opens the AAF and extracts its embedded essence to target, which is
+# created once the AAF has opened. Returns False if the file can't be
+# opened.
+def open_aaf(aaf_interface, filename, target, progress=None, stats=None, converter=None):
+    stats = stats or ImportStats()
+    report_progress(progress, "parse", "Opening %s..." % os.path.basename(filename))
+    with stats.stage("open"):
+        if not aaf_interface.open(filename):
+            return False
+
+    log("Getting data from %s..." % filename)
     meta = aaf_interface.get_aaf_metadata()
     if meta:
-        print(
+        log(
             "AAF created on %s with %s %s version %s using %s"
             % (
                 str(meta.get("date", "")),
@@ -747,52 +2835,497 @@ def parse_aaf(aaf_interface, filename, target):
             )
         )
 
-    aaf_interface.extract_essence(target, None)
+    os.makedirs(target, exist_ok=True)
+    with stats.stage("extract"):
+        aaf_interface.extract_essence(target, progress, converter)
+    stats.count("files_extracted", aaf_interface.files_extracted)
+    stats.count("bytes_extracted", aaf_interface.bytes_extracted)
+    return True
+
+
+def parse_aaf(aaf_interface, filename, target, progress=None, stats=None, converter=None):
+    stats = stats or ImportStats()
+    if not open_aaf(aaf_interface, filename, target, progress, stats, converter):
+        return None
 
     composition_list = aaf_interface.get_composition_list()
     composition_id = 0
     if len(composition_list) > 1:
-        print(
+        log(
             "Multiple compositions found, using first: %s" % composition_list[0],
             WARNING,
         )
 
-    return aaf_interface.get_composition(composition_id)
-
-
-def import_aaf(myDirectory, myAAFfile):
+    report_progress(progress, "parse", "Reading the timeline...")
+    with stats.stage("timeline"):
+        return aaf_interface.get_composition(composition_id)
+
+
+# Picks compositions out of the names get_composition_list returns.
+# wanted is "all" or a list of names and/or indices. Returns the indices,
+# in the order given; raises VeaperError for one that doesn't exist.
+def select_compositions(composition_list, wanted):
+    if wanted == "all":
+        return list(range(len(composition_list)))
+    indices = []
+    for choice in wanted:
+        if isinstance(choice, int) or str(choice).isdigit():
+            index = int(choice)
+            if not 0 <= index < len(composition_list):
+                raise VeaperError("No composition %d, the AAF has %d" % (index, len(composition_list)))
+        elif choice in composition_list:
+            index = composition_list.index(choice)
+        else:
+            raise VeaperError("No composition named %s, found: %s" % (choice, ", ".join(composition_list)))
+        if index not in indices:
+            indices.append(index)
+    return indices
+
+
+# Runs in a worker process: reads one composition through its own handle
+# on the AAF. paths maps (mob_id_key, slot_id) to the essence files the
+# parent already extracted or found, so nothing is done twice.
+def read_composition(filename, composition, paths, include_video=False):
+    aaf_interface = AAFInterface(os.path.dirname(filename), include_video=include_video)
+    if not aaf_interface.open(filename, scan_media=False):
+        raise VeaperError("Could not open AAF file %s" % filename)
+    try:
+        for (mob_id, slot_id), entry in aaf_interface.mob_index.items():
+            entry["path"] = paths.get((mob_id_key(mob_id), slot_id), entry["path"])
+        return aaf_interface.get_composition(composition)
+    finally:
+        aaf_interface.aaf.close()
+
+
+# Worker side of parallel extraction (see AAFInterface.extract_essence):
+# opens a read-only handle of its own to the AAF and extracts files, a
+# list of (source MobID, file name or per channel names, descriptor).
+# Returns the bytes read.
+def extract_essence_batch(filename, files, chunk_size=ESSENCE_CHUNK_SIZE, peaks=False):
+    aaf_interface = AAFInterface(os.path.dirname(filename), chunk_size, peaks=peaks)
+    try:
+        aaf_interface.aaf = aaf2.open(filename, "r")
+    except Exception:
+        raise VeaperError("Could not open AAF file %s" % filename)
+    try:
+        for mob_id, path, descriptor in files:
+            aaf_interface.extract_embedded_essence(aaf_interface.aaf.content.mobs.get(mob_id), path, descriptor)
+    finally:
+        aaf_interface.aaf.close()
+    return aaf_interface.bytes_extracted
+
+
+# Reads the chosen compositions of an opened AAF (see open_aaf), several
+# at once on the converter's worker processes. Returns a list of
+# (name, composition) in the order of indices.
+def parse_compositions(aaf_interface, filename, indices, converter=None, progress=None):
+    names = aaf_interface.get_composition_list()
+    if len(indices) == 1:
+        report_progress(progress, "parse", "Reading %s..." % names[indices[0]])
+        return [(names[indices[0]], aaf_interface.get_composition(indices[0]))]
+
+    paths = {(mob_id_key(mob_id), slot_id): entry["path"]
+             for (mob_id, slot_id), entry in aaf_interface.mob_index.items()}
+    jobs = [(index, read_composition, (filename, index, paths, aaf_interface.include_video)) for index in indices]
+    own_converter = converter is None
+    if own_converter:
+        converter = MediaConverter()
+    compositions = {}
+    report_progress(progress, "parse", "Reading %d compositions..." % len(indices), 0, len(indices))
+    try:
+        for done, (index, composition, error) in enumerate(converter.run(jobs), 1):
+            if error is not None:
+                raise VeaperError("Failed to read composition %s: %s" % (names[index], error))
+            compositions[index] = composition
+            report_progress(progress, "parse", "Read %s" % names[index], done, len(indices))
+    finally:
+        if own_converter:
+            converter.shutdown()
+    return [(names[index], compositions[index]) for index in indices]
+
+
+# File names for a composition's project, unique within one export.
+def composition_file_name(name, used_names):
+    safe = "".join(c if c.isalnum() or c in " -_." else "_" for c in name or "").strip(" .") or "composition"
+    unique = safe
+    number = 2
+    while unique.lower() in used_names:
+        unique = "%s_%d" % (safe, number)
+        number += 1
+    used_names.add(unique.lower())
+    return unique
+
+
+# Imports one AAF and returns the path of the written project. Raises
+# VeaperError if the AAF can't be read, or after writing the project if
+# some media failed to convert. All paths are used as given, so pass
+# absolute ones if the working directory may change meanwhile.
+#
+# By default only the first composition is imported, to my_project.rpp.
+# compositions ("all", or a list of names and/or indices, see
+# select_compositions) exports each chosen composition to its own
+# <name>.rpp instead, sharing one media conversion pass, and returns the
+# list of written projects.
+#
+# incremental compares each composition with the sidecar of the previous
+# export to the same folder, logs what changed per track and only reads
+# media that is new or was modified since. With update_tracks as well,
+# only changed tracks are rewritten in the existing project, so edits
+# made in Reaper to the other tracks survive.
+#
+# Picture tracks are only read, and put in the sidecar, with include_video.
+#
+# media_index (see MediaIndex) lets imports share one index of the media
+# folders instead of each scanning the AAF's folder and search_paths.
+#
+# staging picks how WAV sources are put in the project (see
+# STAGING_POLICIES): linked or cloned where the filesystem allows it,
+# copied, or referenced where they are.
+#
+# Embedded essence is extracted on the converter's workers, or on a pool
+# of extract_workers processes of its own if that is given (1 extracts
+# serially). split_channels writes multichannel embedded essence to one
+# mono WAV per channel, each clip using its channel's file.
+#
+# The project runs at sample_rate (default: the highest source rate).
+# normalize resamples and requantizes the sources that don't match it, or
+# bit_depth (default: the widest among them), while converting.
+#
+# With peaks, every WAV in the project folder gets a REAPER peak file
+# (<name>.wav.reapeaks), so the project opens without REAPER reading all
+# the audio to draw waveforms. Peak files need NumPy; by default (None)
+# they are written if it is installed.
+#
+# Every import writes timing_report.json (see ImportStats) next to the
+# project. profile runs the whole import under cProfile and saves the
+# profile (profile.prof, and the top functions in profile.txt) there too.
+def import_aaf(myDirectory, myAAFfile, converter=None, profile=False, **options):
+    if profile:
+        return profile_import(myDirectory, myAAFfile, converter, options)
+    return _import_aaf(myDirectory, myAAFfile, converter, **options)
+
+
+# The import itself, see import_aaf for the options.
+def _import_aaf(myDirectory, myAAFfile, converter=None, cache_dir=None, cache_max_size=SHARED_CACHE_MAX_SIZE,
+                consolidate=False, handles=CONSOLIDATE_HANDLES, destination_folder=None, progress=None,
+                search_paths=None, thin=False, volume_tolerance=VOLUME_TOLERANCE_DB, pan_tolerance=PAN_TOLERANCE,
+                compositions=None, incremental=False, update_tracks=False, sidecar_format="json",
+                include_video=False, staging="link", normalize=False, sample_rate=None, bit_depth=None,
+                extract_workers=None, split_channels=False, peaks=None, media_index=None):
+    if peaks is None:
+        peaks = peaks_available()
+    elif peaks and np is None:
+        raise VeaperError("Writing peak files needs NumPy")
+    staging_policy(staging)
+
+    stats = ImportStats()
+    aaf_interface = AAFInterface(myDirectory, search_paths=search_paths, include_video=include_video,
+                                 split_channels=split_channels, peaks=peaks, media_index=media_index)
+    if destination_folder is None:
+        destination_folder = os.path.join(myDirectory, "Reaper_from_DaVinci")
+
+    extractor = converter if extract_workers is None else MediaConverter(extract_workers)
+    try:
+        if compositions is None:
+            composition = parse_aaf(aaf_interface, myAAFfile, destination_folder, progress, stats, extractor)
+            opened = composition is not None
+        else:
+            opened = open_aaf(aaf_interface, myAAFfile, destination_folder, progress, stats, extractor)
+    finally:
+        if extractor is not converter:
+            extractor.shutdown()
+    if not opened:
+        raise VeaperError("Could not open AAF file %s" % myAAFfile)
+
+    if compositions is None:
+        projects = [("Audio_data_from_aaf", "my_project.rpp", composition)]
+    else:
+        indices = select_compositions(aaf_interface.get_composition_list(), compositions)
+        used_names = set()
+        projects = []
+        with stats.stage("timeline"):
+            parsed = parse_compositions(aaf_interface, myAAFfile, indices, converter, progress)
+        for name, composition in parsed:
+            name = composition_file_name(name, used_names)
+            projects.append(("Audio_data_from_aaf_%s" % name, name + ".rpp", composition))
+
+    # One view over every composition, so media used by several is
+    # converted once.
+    combined = {"tracks": [track for _, _, composition in projects for track in composition["tracks"]]}
+
+    if thin:
+        with stats.stage("thin"):
+            thin_envelopes(combined, volume_tolerance, pan_tolerance)
+
+    previous = {}
+    if incremental or update_tracks:
+        for sidecar_name, _, _ in projects:
+            try:
+                sidecar = read_sidecar(os.path.join(destination_folder, sidecar_name))
+            except Exception as e:
+                log("Could not read the previous %s: %s" % (sidecar_name, e), WARNING)
+                sidecar = None
+            if sidecar is not None:
+                previous[sidecar_name] = sidecar
+            else:
+                log("No previous export of %s, doing a full one." % sidecar_name)
+    for sidecar_name, _, composition in projects:
+        assign_track_ids(composition, previous.get(sidecar_name))
+
+    cache = ConversionCache(destination_folder, cache_dir, cache_max_size, trust_mtime=incremental or update_tracks)
+    referenced_sources = get_referenced_sources(combined)
+    ranges = collect_source_ranges(combined, handles) if consolidate else None
+    failures = {}
+    media_index = aaf_interface.media_index
+    with stats.stage("convert"):
+        sample_rate = convert_referenced_media(referenced_sources, myDirectory, destination_folder, converter, cache,
+                                               ranges, failures, progress, media_index, stats, staging,
+                                               normalize, sample_rate, bit_depth, peaks)
+
+    with stats.stage("rewrite"):
+        rewrite_sources_for_reaper(combined, myDirectory, cache, ranges, media_index, destination_folder)
+    if media_index is not None:
+        stats.count("media_files_indexed", len(media_index.paths))
+        stats.count("media_scan_seconds", media_index.scan_seconds)
+
+    rpp_paths = []
+    for sidecar_name, rpp_name, composition in projects:
+        with stats.stage("sidecar"):
+            write_sidecar(composition, os.path.join(destination_folder, sidecar_name), sidecar_format)
+
+        report_progress(progress, "write", "Writing %s..." % rpp_name)
+        rpp_path = os.path.join(destination_folder, rpp_name)
+        rpp_paths.append(rpp_path)
+        with stats.stage("write"):
+            if sidecar_name in previous:
+                changes = diff_compositions(previous[sidecar_name], composition)
+                log_changes(changes)
+                if update_tracks and os.path.isfile(rpp_path):
+                    if all(change["status"] == "unchanged" for change in changes.values()):
+                        log("Reaper project %s left as it is" % rpp_path)
+                        continue
+                    if update_reaper_project(composition, changes, rpp_path):
+                        log("Changed tracks written to %s" % rpp_path)
+                        continue
+                    log("No tracks of %s can be matched to the AAF, rewriting all of them" % rpp_path, WARNING)
+            write_reaper_project(composition, sample_rate, rpp_path)
+            log("Reaper project written to %s" % rpp_path)
+
+    stats.count("failed_files", len(failures))
+    write_json_file(os.path.join(destination_folder, TIMING_REPORT_NAME), stats.report())
+    log("Timings: %s" % stats.summary())
+
+    if failures:
+        raise VeaperError("Failed to convert %d media files: %s" % (len(failures), ", ".join(sorted(failures))))
+    return rpp_paths[0] if compositions is None else rpp_paths
+
+
+# Whether peak files are written by default: only with NumPy, without
+# which they would cost more than the conversion. Says so once.
+def peaks_available():
+    global peaks_warning_given
+    if np is None and not peaks_warning_given:
+        log("NumPy is not installed, so no Reaper peak files are written (pip install numpy)", WARNING)
+        peaks_warning_given = True
+    return np is not None
+
+
+# Runs the import with options under cProfile. cProfile sees only this
+# thread, so conversions in worker processes show up as waiting.
+def profile_import(myDirectory, myAAFfile, converter, options):
+    destination_folder = options.get("destination_folder") or os.path.join(myDirectory, "Reaper_from_DaVinci")
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows one active profiler, e.g. with -j > 1.
+        log("Another import is being profiled, not profiling %s" % myAAFfile, WARNING)
+        return _import_aaf(myDirectory, myAAFfile, converter, **options)
+    try:
+        return _import_aaf(myDirectory, myAAFfile, converter, **options)
+    finally:
+        profiler.disable()
+        os.makedirs(destination_folder, exist_ok=True)
+        profiler.dump_stats(os.path.join(destination_folder, PROFILE_NAME))
+        with open(os.path.join(destination_folder, PROFILE_SUMMARY_NAME), "w") as summary:
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(40)
+        log("Profile written to %s" % os.path.join(destination_folder, PROFILE_NAME))
+
+
+def expand_aaf_arguments(patterns):
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            log("No files match %s" % pattern, WARNING)
+        for match in matches:
+            match = os.path.abspath(match)
+            if match not in files:
+                files.append(match)
+    return files
+
+
+# Options shared by the command line tools (main here, and veaperWatch):
+# the conversion pool size, logging and everything import_aaf can do.
+def add_import_arguments(parser):
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of media conversion processes (default: one per CPU)")
+    parser.add_argument("--log-level", choices=["notice", "warning", "error", "none"], default="notice")
+    parser.add_argument("-s", "--search-path", action="append", default=[],
+                        help="extra folder to look for media in, subfolders included (repeatable)")
+    parser.add_argument("--all-compositions", action="store_true",
+                        help="export every composition in the AAF, each to its own project")
+    parser.add_argument("-c", "--composition", action="append", default=[],
+                        help="composition to export, by name or index (repeatable); default: the first")
+    parser.add_argument("--incremental", action="store_true",
+                        help="compare with the previous export, report changes and only read new media")
+    parser.add_argument("--update-tracks", action="store_true",
+                        help="with --incremental, rewrite only changed tracks in the existing project")
+    parser.add_argument("--include-video", action="store_true",
+                        help="also read picture tracks and locate video media, for the sidecar")
+    parser.add_argument("--thin-envelopes", action="store_true",
+                        help="simplify volume and pan envelopes within the errors below")
+    parser.add_argument("--max-volume-error", type=float, default=VOLUME_TOLERANCE_DB,
+                        help="largest volume change thinning may cause, in dB (default: %(default)g)")
+    parser.add_argument("--max-pan-error", type=float, default=PAN_TOLERANCE,
+                        help="largest pan change thinning may cause, -1 to 1 scale (default: %(default)g)")
+    parser.add_argument("--sidecar-format", choices=sorted(SIDECAR_EXTENSIONS), default="json",
+                        help="format of the Audio_data_from_aaf sidecar; pretty is indented JSON for debugging,"
+                             " msgpack needs the msgpack package (default: json)")
+    parser.add_argument("--staging", choices=sorted(STAGING_POLICIES), default="link",
+                        help="how WAV sources get into the project: link (copy-on-write clone, falling back"
+                             " to a copy), hardlink or symlink (sharing the source's data, falling back to a"
+                             " copy), copy, or reference them where they are"
+                             " (default: %(default)s)")
+    parser.add_argument("--split-channels", action="store_true",
+                        help="extract multichannel embedded audio to one mono WAV per channel")
+    parser.add_argument("--extract-workers", type=int,
+                        help="processes extracting embedded audio from each AAF (default: the -w pool)")
+    parser.add_argument("--sample-rate", type=int,
+                        help="project sample rate (default: the highest rate among the sources)")
+    parser.add_argument("--normalize", action="store_true",
+                        help="resample and requantize sources to the project rate and --bit-depth;"
+                             " needs numpy, and soxr or scipy for resampling")
+    parser.add_argument("--bit-depth", type=int, choices=[16, 24, 32],
+                        help="sample width for --normalize (default: the widest among the sources)")
+    parser.add_argument("--no-peaks", dest="peaks", action="store_false", default=None,
+                        help="don't write REAPER peak files (.reapeaks) next to the WAVs;"
+                             " they are only written when numpy is installed")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile each import with cProfile, saving %s and %s next to the project"
+                             % (PROFILE_NAME, PROFILE_SUMMARY_NAME))
+    parser.add_argument("--cache-dir", help="shared conversion cache folder, reused across projects")
+    parser.add_argument("--cache-max-size", type=float, default=SHARED_CACHE_MAX_SIZE / 1024 ** 3,
+                        help="size limit of the shared cache in GiB (default: %(default)g)")
+    parser.add_argument("--consolidate", action="store_true", help="convert only the used parts of each source")
+    parser.add_argument("--handles", type=float, default=CONSOLIDATE_HANDLES,
+                        help="seconds kept around each used part when consolidating (default: %(default)g)")
+
+
+# Applies --log-level, checks the options added by add_import_arguments and
+# returns them as import_aaf keyword arguments.
+def import_options(parser, args):
     global log_level
 
-    aaf_interface = AAFInterface(myDirectory)
-    target = "Reaper_from_DaVinci"
-    destination_folder = os.path.join(myDirectory, target)
-
-    if not os.path.exists(destination_folder):
-        os.mkdir(destination_folder)
-
-    log_level = NOTICE
-
-    composition = parse_aaf(aaf_interface, myAAFfile, destination_folder)
-    if composition is None:
-        return
-
-    json_path = os.path.join(destination_folder, "Audio_data_from_aaf.json")
-    with open(json_path, "w") as json_file:
-        json.dump(composition, json_file, indent=4)
-
-    referenced_sources = get_referenced_sources(composition)
-    sample_rate = convert_referenced_media(referenced_sources, myDirectory, destination_folder)
-
-    rewrite_sources_for_reaper(composition, myDirectory)
-
-    with open(json_path, "w") as json_file:
-        json.dump(composition, json_file, indent=4)
-
-    reaper_project = build_reaper_project(composition, sample_rate)
-
-    rpp_path = os.path.join(destination_folder, "my_project.rpp")
-    with open(rpp_path, "w") as file:
-        file.write(reaper_project)
-
-    print("Reaper project written to %s" % rpp_path)
+    log_level = ["notice", "warning", "error", "none"].index(args.log_level)
+
+    if args.sidecar_format == "msgpack" and msgpack is None:
+        parser.error("--sidecar-format msgpack needs the msgpack package")
+    if args.normalize and np is None:
+        parser.error("--normalize needs the numpy package")
+
+    compositions = None
+    if args.all_compositions:
+        compositions = "all"
+    elif args.composition:
+        compositions = args.composition
+
+    return {
+        "cache_dir": args.cache_dir,
+        "cache_max_size": int(args.cache_max_size * 1024 ** 3),
+        "consolidate": args.consolidate,
+        "handles": args.handles,
+        "search_paths": args.search_path,
+        "thin": args.thin_envelopes,
+        "volume_tolerance": args.max_volume_error,
+        "pan_tolerance": args.max_pan_error,
+        "compositions": compositions,
+        "incremental": args.incremental,
+        "update_tracks": args.update_tracks,
+        "sidecar_format": args.sidecar_format,
+        "profile": args.profile,
+        "include_video": args.include_video,
+        "staging": args.staging,
+        "normalize": args.normalize,
+        "sample_rate": args.sample_rate,
+        "bit_depth": args.bit_depth,
+        "extract_workers": args.extract_workers,
+        "split_channels": args.split_channels,
+        "peaks": args.peaks,
+    }
+
+
+# The project folder of an AAF: named after it, under output_dir if given
+# or in Reaper_from_DaVinci next to the AAF otherwise.
+def project_destination(aaf_file, output_dir=None):
+    name = os.path.splitext(os.path.basename(aaf_file))[0]
+    base = output_dir or os.path.join(os.path.dirname(aaf_file), "Reaper_from_DaVinci")
+    return os.path.join(os.path.abspath(base), name)
+
+
+# Command line entry point. Imports every AAF given, several at a time,
+# with all of them sharing one pool of conversion workers. Each AAF gets
+# its own project folder (see project_destination).
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert DaVinci Resolve AAF exports into Reaper projects.")
+    parser.add_argument("aaf", nargs="+", help="AAF files or glob patterns")
+    parser.add_argument("-o", "--output-dir", help="folder to write the project folders to")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="number of AAFs to import at once (default: 2)")
+    add_import_arguments(parser)
+    args = parser.parse_args(argv)
+    options = import_options(parser, args)
+
+    files = expand_aaf_arguments(args.aaf)
+    if not files:
+        parser.error("no AAF files to import")
+
+    destinations = {}
+    for aaf_file in files:
+        destination = project_destination(aaf_file, args.output_dir)
+        if destination in destinations.values():
+            parser.error("more than one AAF would be written to %s" % destination)
+        destinations[aaf_file] = destination
+
+    results = {}
+    # Scanned once for all the imports; each adds the folder of its AAF.
+    media_index = MediaIndex(options["search_paths"])
+
+    def run_job(aaf_file):
+        start = time.time()
+        try:
+            rpp_path = import_aaf(os.path.dirname(aaf_file), aaf_file, converter,
+                                  destination_folder=destinations[aaf_file], media_index=media_index, **options)
+            if options["compositions"] is not None:
+                rpp_path = ", ".join(rpp_path)
+            results[aaf_file] = (True, rpp_path, time.time() - start)
+        except Exception as e:
+            log("%s: %s" % (os.path.basename(aaf_file), e), ERROR)
+            results[aaf_file] = (False, str(e), time.time() - start)
+
+    with MediaConverter(args.workers) as converter:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            list(executor.map(run_job, files))
+
+    failed = 0
+    print("\nSummary:")
+    for aaf_file in files:
+        ok, detail, elapsed = results[aaf_file]
+        failed += not ok
+        print("  %-6s %s (%.1fs): %s" % ("OK" if ok else "FAILED", os.path.basename(aaf_file), elapsed, detail))
+    print("%d of %d imports succeeded." % (len(files) - failed, len(files)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
 
@@ -0,0 +1,443 @@
+import os
+import sys
+import time
+import queue
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import argparse
+import threading
+import multiprocessing
+
+from veaperProcessing import (import_aaf, MediaConverter, MediaIndex, VeaperCancelled, add_import_arguments,
+                              import_options, project_destination, read_linked_media, load_json_file,
+                              write_json_file, log, WARNING, ERROR, TIMING_REPORT_NAME)
+
+# Watch folder service. Editors drop AAF exports (and their MXFs) into
+# the watched folders; every AAF is imported once it and the media it links
+# to have stopped changing, the same way the command line would:
+#
+#    python veaperWatch.py /Volumes/Exports -o /Volumes/Mix/Projects
+#
+# Folders are watched with inotify on Linux, and polled elsewhere. Ready
+# AAFs go into a bounded queue served by a few import threads, which share
+# one pool of conversion processes, and one index of the media folders
+# (the watched folders and --search-path). A failed import is retried a
+# few times, further apart each time; an AAF that changes is imported again.
+#
+# The state of every job, the queue depth and the throughput are written
+# to a status file (veaper_watch_status.json in the first folder by
+# default). The service picks its state up from there when restarted, so
+# AAFs already imported aren't imported again.
+
+STATUS_FILE_NAME = "veaper_watch_status.json"
+# Seconds between scans while AAFs are settling, queued or being imported.
+POLL_INTERVAL = 5.0
+# With inotify and nothing waiting, folders are still rescanned this often.
+IDLE_RESCAN = 60.0
+# An AAF is ready once it and its media haven't changed for this long.
+SETTLE_SECONDS = 30.0
+RETRIES = 3
+RETRY_DELAY = 60.0
+RECENT_JOBS = 50
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+# Wakes the service when an AAF is written to or moved into one of the
+# folders (Linux inotify, through libc).
+class InotifyWaker:
+    name = "inotify"
+
+    def __init__(self, folders, stopping):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.stopping = stopping
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        for folder in folders:
+            if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+                error = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(error, "Cannot watch %s" % folder)
+
+    # Returns when an AAF changed, after timeout seconds or on stopping.
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            # Short slices, so a stop request is seen quickly.
+            ready, _, _ = select.select([self.fd], [], [], min(remaining, 1.0))
+            if ready and self.read_events():
+                return
+
+    def read_events(self):
+        woken = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return woken
+            pos = 0
+            while pos + INOTIFY_EVENT.size <= len(data):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+                name = data[pos + INOTIFY_EVENT.size:pos + INOTIFY_EVENT.size + length].rstrip(b"\0")
+                # Ignore everything else, our own status file included.
+                woken = woken or name.lower().endswith(b".aaf")
+                pos += INOTIFY_EVENT.size + length
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWaker:
+    name = "polling"
+
+    def __init__(self, folders, stopping):
+        self.stopping = stopping
+
+    def wait(self, timeout):
+        self.stopping.wait(timeout)
+
+    def close(self):
+        pass
+
+
+# Number of files there, their total size and newest mtime, for paths.
+def files_signature(paths):
+    count = 0
+    size = 0
+    newest = 0
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Not there (yet); when it arrives the count changes.
+            continue
+        count += 1
+        size += stat.st_size
+        newest = max(newest, stat.st_mtime_ns)
+    return [count, size, newest]
+
+
+# Jobs are dicts, keyed by the AAF's path:
+#   state        "waiting", "queued", "running", "retry", "done" or "failed"
+#   aaf          [size, mtime] of the AAF when the job was made
+#   signature    files_signature of the AAF and its linked media last
+#                seen, and stable_since the time it was first seen (only
+#                while waiting)
+#   attempts     imports tried so far; retry_at, when to try again
+#   error, seconds, finished, projects
+#                outcome of the last import
+class WatchService:
+
+    def __init__(self, folders, output_dir=None, options=None, workers=None, jobs=2, queue_size=None,
+                 settle=SETTLE_SECONDS, poll_interval=POLL_INTERVAL, retries=RETRIES, retry_delay=RETRY_DELAY,
+                 status_file=None, polling=False):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.output_dir = output_dir and os.path.abspath(output_dir)
+        self.options = dict(options or {})
+        # Shared by the scans and every import (see MediaIndex).
+        self.media_index = MediaIndex(self.folders + list(self.options.get("search_paths") or []))
+        self.options["media_index"] = self.media_index
+        # {AAF path: (its [size, mtime], read_linked_media of it)}
+        self.linked_media = {}
+        self.workers = workers
+        self.job_count = max(1, jobs)
+        self.queue = queue.Queue(maxsize=queue_size or self.job_count * 2)
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.status_file = status_file or os.path.join(self.folders[0], STATUS_FILE_NAME)
+        self.polling = polling
+
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.converter = None
+        self.waker = None
+        self.started = time.time()
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self.bytes_processed = 0
+        self.jobs = {}
+        self.load_status()
+
+    # Keeps the outcome of finished jobs from the last run, so unchanged
+    # AAFs aren't imported again.
+    def load_status(self):
+        for path, job in load_json_file(self.status_file).get("jobs", {}).items():
+            if job.get("state") in ("done", "failed"):
+                self.jobs[path] = job
+
+    def find_aafs(self):
+        for folder in self.folders:
+            try:
+                entries = list(os.scandir(folder))
+            except OSError as e:
+                log("Cannot read %s: %s" % (folder, e), WARNING)
+                continue
+            for entry in entries:
+                if entry.name.lower().endswith(".aaf") and not entry.name.startswith("."):
+                    yield entry.path
+
+    # The files whose changes mean the export of an AAF is still being
+    # written: the AAF and the media it links to. The links are read once
+    # per version of the AAF; an AAF that can't be read yet only has itself.
+    def export_files(self, path, aaf):
+        known = self.linked_media.get(path)
+        if known is None or known[0] != aaf:
+            try:
+                media = read_linked_media(path)
+            except Exception:
+                media = []
+            known = self.linked_media[path] = (aaf, media)
+        files = {path}
+        for url, mob_id in known[1]:
+            files.add(self.media_index.find(url, mob_id) or url)
+        return sorted(files)
+
+    def scan(self):
+        now = time.time()
+        found = set()
+        for path in self.find_aafs():
+            found.add(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            aaf = [stat.st_size, stat.st_mtime_ns]
+
+            with self.lock:
+                job = self.jobs.get(path)
+                if job is None or job["aaf"] != aaf and job["state"] not in ("queued", "running"):
+                    job = self.jobs[path] = {"state": "waiting", "aaf": aaf, "attempts": 0}
+                if job["state"] in ("queued", "running", "done", "failed"):
+                    continue
+                if job["state"] == "retry" and now < job["retry_at"]:
+                    continue
+
+            signature = files_signature(self.export_files(path, aaf))
+            with self.lock:
+                if job.get("signature") != signature:
+                    job["signature"] = signature
+                    job["stable_since"] = now
+                    job["state"] = "waiting"
+                    continue
+                if now - job["stable_since"] < self.settle or now - signature[2] / 1e9 < self.settle:
+                    continue
+                try:
+                    self.queue.put_nowait(path)
+                except queue.Full:
+                    # Picked up by a later scan.
+                    continue
+                job["state"] = "queued"
+                log("Queued %s" % path)
+
+        with self.lock:
+            # Forget AAFs that went away before they were imported.
+            for path in [path for path, job in self.jobs.items() if job["state"] == "waiting" and path not in found]:
+                del self.jobs[path]
+            for path in [path for path in self.linked_media if path not in found]:
+                del self.linked_media[path]
+
+    # True while any job isn't finished. Running ones may need a retry.
+    def has_pending(self):
+        with self.lock:
+            return any(job["state"] not in ("done", "failed") for job in self.jobs.values())
+
+    def run_jobs(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            with self.lock:
+                job = self.jobs[path]
+                job["state"] = "running"
+                job["attempts"] += 1
+            self.write_status()
+            self.run_job(path, job)
+            self.write_status()
+
+    def run_job(self, path, job):
+        destination = project_destination(path, self.output_dir)
+        start = time.time()
+        try:
+            projects = import_aaf(os.path.dirname(path), path, self.converter, destination_folder=destination,
+                                  **self.options)
+            error = None
+        except VeaperCancelled:
+            error = "cancelled"
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+        seconds = time.time() - start
+        report = load_json_file(os.path.join(destination, TIMING_REPORT_NAME))
+
+        with self.lock:
+            self.busy_seconds += seconds
+            job.update(seconds=seconds, finished=time.time(), error=error)
+            job.pop("signature", None)
+            job.pop("stable_since", None)
+            if error is None:
+                self.completed += 1
+                self.bytes_processed += report.get("counters", {}).get("source_bytes", 0)
+                job["state"] = "done"
+                job["projects"] = projects if isinstance(projects, list) else [projects]
+                log("Imported %s in %.1fs" % (path, seconds))
+            elif self.stopping.is_set():
+                # Not persisted, so tried again when the service next starts.
+                job["state"] = "waiting"
+            elif job["attempts"] <= self.retries:
+                job["state"] = "retry"
+                job["retry_at"] = time.time() + self.retry_delay * 2 ** (job["attempts"] - 1)
+                log("Import of %s failed (%s), retrying in %.0fs"
+                    % (path, error, job["retry_at"] - time.time()), WARNING)
+            else:
+                job["state"] = "failed"
+                log("Import of %s failed: %s" % (path, error), ERROR)
+
+    def write_status(self):
+        with self.lock:
+            states = [job["state"] for job in self.jobs.values()]
+            uptime = time.time() - self.started
+            # The most recently finished jobs, and every unfinished one.
+            finished = sorted((job.get("finished", 0), path) for path, job in self.jobs.items()
+                              if job["state"] in ("done", "failed"))
+            keep = {path for _, path in finished[-RECENT_JOBS:]}
+            status = {
+                "version": 1,
+                "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "pid": os.getpid(),
+                "folders": self.folders,
+                "watcher": self.waker.name if self.waker else None,
+                "queue_depth": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                "counts": {state: states.count(state) for state in ("waiting", "queued", "running", "retry",
+                                                                    "done", "failed")},
+                "throughput": {
+                    "imported": self.completed,
+                    "imports_per_hour": self.completed / uptime * 3600 if uptime else 0.0,
+                    "average_seconds": self.busy_seconds / self.completed if self.completed else None,
+                    "source_mb_per_second": self.bytes_processed / self.busy_seconds / 1e6
+                    if self.busy_seconds else None,
+                },
+                "jobs": {path: dict(job) for path, job in self.jobs.items()
+                         if path in keep or job["state"] not in ("done", "failed")},
+            }
+            try:
+                write_json_file(self.status_file, status)
+            except OSError as e:
+                log("Cannot write %s: %s" % (self.status_file, e), WARNING)
+
+    # First request: stop queueing and finish the running imports.
+    # Second: cancel them too.
+    def stop(self, signum=None, frame=None):
+        if os.getpid() != self.pid:
+            # A conversion worker, forked with this handler. Leave Ctrl-C to
+            # the service, and die of anything else.
+            if signum is not None and signum != signal.SIGINT:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+            return
+        if self.stopping.is_set():
+            log("Cancelling running imports...", WARNING)
+            if self.converter is not None:
+                self.converter.cancel()
+            return
+        log("Stopping after the running imports (again to cancel them)...", WARNING)
+        self.stopping.set()
+
+    def run(self):
+        if not self.polling:
+            try:
+                self.waker = InotifyWaker(self.folders, self.stopping)
+            except OSError as e:
+                log("Polling the folders instead of watching them: %s" % e)
+        if self.waker is None:
+            self.waker = PollingWaker(self.folders, self.stopping)
+        log("Watching %s (%s)" % (", ".join(self.folders), self.waker.name))
+        # Only inotify can tell when a new AAF arrives.
+        idle_interval = IDLE_RESCAN if isinstance(self.waker, InotifyWaker) else self.poll_interval
+
+        self.converter = MediaConverter(self.workers).start()
+        threads = [threading.Thread(target=self.run_jobs, daemon=True) for _ in range(self.job_count)]
+        for thread in threads:
+            thread.start()
+        try:
+            while not self.stopping.is_set():
+                self.scan()
+                self.write_status()
+                self.waker.wait(self.poll_interval if self.has_pending() else idle_interval)
+        finally:
+            self.stopping.set()
+            # Queued jobs go back to waiting; they are picked up next time.
+            while True:
+                try:
+                    path = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                with self.lock:
+                    self.jobs[path]["state"] = "waiting"
+            for _ in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+            self.converter.shutdown()
+            self.waker.close()
+            self.write_status()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch folders for AAF exports and import them into Reaper "
+                                                 "projects as they arrive.")
+    parser.add_argument("folders", nargs="+", help="folders to watch for AAF files")
+    parser.add_argument("-o", "--output-dir", help="folder to write the project folders to "
+                                                   "(default: Reaper_from_DaVinci next to each AAF)")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="number of AAFs to import at once (default: 2)")
+    parser.add_argument("--queue-size", type=int,
+                        help="most AAFs waiting for an import thread at once (default: twice --jobs)")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS,
+                        help="seconds an AAF and its media must stay unchanged before import (default: %(default)g)")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                        help="seconds between scans while AAFs are settling (default: %(default)g)")
+    parser.add_argument("--retries", type=int, default=RETRIES,
+                        help="times a failed import is retried (default: %(default)d)")
+    parser.add_argument("--retry-delay", type=float, default=RETRY_DELAY,
+                        help="seconds before the first retry, doubling after each (default: %(default)g)")
+    parser.add_argument("--status-file",
+                        help="where to write the service status (default: %s in the first folder)"
+                             % STATUS_FILE_NAME)
+    parser.add_argument("--polling", action="store_true", help="poll the folders even where inotify works")
+    add_import_arguments(parser)
+    args = parser.parse_args(argv)
+    options = import_options(parser, args)
+
+    for folder in args.folders:
+        if not os.path.isdir(folder):
+            parser.error("%s is not a folder" % folder)
+
+    service = WatchService(args.folders, args.output_dir, options, args.workers, args.jobs, args.queue_size,
+                           args.settle, args.poll_interval, args.retries, args.retry_delay, args.status_file,
+                           args.polling)
+    signal.signal(signal.SIGINT, service.stop)
+    signal.signal(signal.SIGTERM, service.stop)
+    service.run()
+    return 0
+
+
+if __name__ == "__main__":
+    # Needed for the conversion worker processes in frozen builds.
+    multiprocessing.freeze_support()
+    sys.exit(main())